@@ -0,0 +1,187 @@
+# coding=utf-8
+#
+# Validate all trades read from a file in one go, with NumPy. The checks are
+# the same as validate_trade_info() in port_ft.py and port_12307.py, but done
+# over columns of values instead of row by row, and every failing row is
+# reported instead of only the first one.
+#
+# Each validate function returns a tuple (mask, diagnostics), mask being a
+# boolean array, True for a valid trade, diagnostics being a dictionary
+# mapping a rule name to the array of positions of trades failing it, e.g.,
+#
+# {'fx': array([3, 17]), 'price': array([17])}
+#
+# Batch validation is used only when it is turned on in the config file,
+# see use_batch_validation(). NumPy is optional, it is needed only then.
+#
+
+from trade_converter.utility import logger, config
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+
+
+class BatchValidationNotAvailable(Exception):
+	pass
+
+class InvalidTradeInfo(Exception):
+	pass
+
+
+
+def use_batch_validation():
+	"""
+	Read "validation" in the [input] section of the config object, 'row' or
+	'batch'. If it is empty, validate row by row.
+
+	Note that with batch validation, an invalid trade is reported after
+	the whole file is read, not when its row is read, and every invalid
+	trade is logged, not only the first one.
+	"""
+	validation = config.get('input', 'validation', fallback='').strip()
+	if validation == 'batch':
+		if np is None:
+			logger.error('use_batch_validation(): NumPy is not installed')
+			raise BatchValidationNotAvailable()
+		return True
+	else:
+		return False
+
+
+
+def get_column(trades, fld):
+	"""
+	Return the values of the field as a float array. If some value is not
+	a number, log the field and the value, then throw an error.
+	"""
+	try:
+		return np.fromiter((trade_info[fld] for trade_info in trades), float, len(trades))
+	except (ValueError, TypeError):
+		for trade_info in trades:
+			try:
+				float(trade_info[fld])
+			except (ValueError, TypeError):
+				logger.error('get_column(): {0} is not a number: {1}'.
+								format(fld, repr(trade_info[fld])))
+				break
+
+		raise InvalidTradeInfo()
+
+
+
+def get_float_column(trades, fld):
+	"""
+	Return a tuple (values, is_float), where values not of type float are
+	NaN.
+	"""
+	is_float = np.fromiter((isinstance(trade_info[fld], float) for trade_info in trades),
+							bool, len(trades))
+	values = np.fromiter((trade_info[fld] if isinstance(trade_info[fld], float) else np.nan \
+							for trade_info in trades), float, len(trades))
+	return values, is_float
+
+
+
+def get_date_column(trades, fld):
+	return np.array([trade_info[fld] for trade_info in trades], dtype='datetime64[us]')
+
+
+
+def get_result(n, failures):
+	"""
+	Combine the failure masks of the rules into the result tuple (mask,
+	diagnostics), rules with no failure are left out of diagnostics.
+	"""
+	mask = np.ones(n, dtype=bool)
+	diagnostics = {}
+	for rule, failed in failures:
+		if failed.any():
+			mask = mask & ~failed
+			diagnostics[rule] = np.flatnonzero(failed)
+
+	return mask, diagnostics
+
+
+
+def validate_ft_trades(trades):
+	"""
+	Batch version of port_ft.validate_trade_info(), rules are:
+
+	1. dates: settlement date or enter date before trade date.
+	2. fx: GROSSBAS*FXRATE not equal to GROSSLCL.
+	3. type: quantity or price of a purchase/sale not of type float.
+	4. price: for a purchase/sale, principal not equal to price * quantity,
+		for equity, nor to price * quantity / 100, for bond.
+	"""
+	n = len(trades)
+	trade_date = get_date_column(trades, 'TRDDATE')
+	bad_dates = (get_date_column(trades, 'STLDATE') < trade_date) | \
+				(get_date_column(trades, 'ENTRDATE') < trade_date)
+
+	fx_rate = get_column(trades, 'FXRATE')
+	bad_fx = np.abs(get_column(trades, 'GROSSBAS') * fx_rate - get_column(trades, 'GROSSLCL')) > 0.01
+
+	purchase_sale = np.fromiter((trade_info['TRANTYP'] in ['Purch', 'Sale'] for trade_info in trades),
+								bool, n)
+	quantity, quantity_is_float = get_float_column(trades, 'QTY')
+	price, price_is_float = get_float_column(trades, 'TRADEPRC')
+	bad_type = purchase_sale & ~(quantity_is_float & price_is_float)
+
+	principal = np.abs(get_column(trades, 'PRINB') * fx_rate)
+	diff2 = principal - quantity*price			# for equity trade
+	diff3 = principal - quantity/100*price		# for bond trade
+	bad_price = purchase_sale & ~bad_type & (np.abs(diff2) > 0.01) & (np.abs(diff3) > 0.01)
+
+	return get_result(n, [('dates', bad_dates), ('fx', bad_fx), ('type', bad_type),
+							('price', bad_price)])
+
+
+
+def validate_12307_trades(trades):
+	"""
+	Batch version of port_12307.validate_trade_info(), rules are:
+
+	1. instruction: B/S is neither 'B' nor 'S'.
+	2. net_settlement: units * unit price, plus (buy) or minus (sell)
+		commission, tax and fees, not equal to the net settlement amount.
+	"""
+	n = len(trades)
+	buy = np.fromiter((trade_info['B/S'] == 'B' for trade_info in trades), bool, n)
+	sell = np.fromiter((trade_info['B/S'] == 'S' for trade_info in trades), bool, n)
+
+	amount = get_column(trades, 'Units') * get_column(trades, 'Unit Price')
+	expenses = get_column(trades, 'Commission') + get_column(trades, 'Tax') + \
+				get_column(trades, 'Fees') + get_column(trades, 'SEC Fee')
+	settled_amount = np.where(buy, amount + expenses, amount - expenses)
+	bad_amount = (buy | sell) & (np.abs(settled_amount - get_column(trades, 'Net Setl')) > 0.1)
+
+	return get_result(n, [('instruction', ~(buy | sell)), ('net_settlement', bad_amount)])
+
+
+
+def check_trades(trades, validate, id_fields, trade_file):
+	"""
+	Validate the trades with the validate function, log every failing
+	trade with the rules it fails.
+
+	id_fields: fields to show in the log to identify a trade, as trades
+	may have been filtered, their positions are not the rows in the file.
+
+	trade_file: the file the trades are read from, shown in the log.
+
+	Return the number of trades failing validation.
+	"""
+	if len(trades) == 0:
+		return 0
+
+	mask, diagnostics = validate(trades)
+	for rule in sorted(diagnostics):
+		for i in diagnostics[rule]:
+			logger.error('check_trades(): {0} validation failed in {1}: {2}'.
+							format(rule, trade_file, ', '.join('{0}={1}'.format(fld, trades[i][fld]) \
+														for fld in id_fields)))
+
+	return len(trades) - int(mask.sum())
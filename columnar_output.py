@@ -0,0 +1,154 @@
+# coding=utf-8
+#
+# Write Geneva records to a columnar file, Parquet or Arrow IPC, for loading
+# into the analytics store without parsing the upload csv file. Each record
+# is one row, trade expenses are a nested column, i.e., a list of
+# (code, amount) for each record, instead of one row for each expense as in
+# the csv file.
+#
+# Amounts (Quantity, Price, CounterTDateFx and expense amounts) are double,
+# an empty value in the csv file is null here, other fields are string.
+#
+# It needs pyarrow, which is optional.
+#
+
+from trade_converter.utility import logger, get_record_fields
+import os
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+
+
+class ColumnarOutputNotAvailable(Exception):
+	pass
+
+class UnknownColumnarFormat(Exception):
+	pass
+
+
+
+numeric_fields = ['Quantity', 'Price', 'CounterTDateFx']
+
+
+
+def get_schema():
+	"""
+	The columnar schema of Geneva records, fields are in the same order as
+	get_record_fields().
+	"""
+	columns = []
+	for fld in get_record_fields():
+		if fld == 'trade_expenses':
+			columns.append(pa.field(fld, pa.list_(pa.struct([('code', pa.string()),
+															('amount', pa.float64())]))))
+		elif fld in numeric_fields:
+			columns.append(pa.field(fld, pa.float64()))
+		else:
+			columns.append(pa.field(fld, pa.string()))
+
+	return pa.schema(columns)
+
+
+
+def to_number(value):
+	if value is None or value == '':
+		return None
+
+	return float(value)
+
+
+
+def to_string(value):
+	if value is None:
+		return None
+
+	return str(value)
+
+
+
+def get_batch(records, schema):
+	"""
+	Convert a list of records to a record batch, column by column.
+	"""
+	columns = []
+	for fld in get_record_fields():
+		values = [record[fld] for record in records]
+		if fld == 'trade_expenses':
+			values = [[{'code':to_string(code), 'amount':to_number(amount)} \
+						for code, amount in trade_expenses] for trade_expenses in values]
+		elif fld in numeric_fields:
+			values = [to_number(value) for value in values]
+		else:
+			values = [to_string(value) for value in values]
+
+		columns.append(pa.array(values, type=schema.field(fld).type))
+
+	return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+
+def open_writer(file, columnar_format, schema):
+	if columnar_format == 'parquet':
+		return pq.ParquetWriter(file, schema)
+	elif columnar_format == 'arrow':
+		return pa.ipc.new_file(file, schema)
+	else:
+		logger.error('open_writer(): unknown columnar format {0}'.format(columnar_format))
+		raise UnknownColumnarFormat()
+
+
+
+def iter_write_columnar(records, file, columnar_format='parquet', batch_size=10000):
+	"""
+	Yield the records unchanged, while writing them to the columnar file in
+	batches of batch_size, so that the same records can be written to the
+	csv file in the same pass, e.g.,
+
+	write_csv(csv_file, iter_write_columnar(records, parquet_file))
+
+	The columnar file is written to a temporary file first, which is
+	renamed to the file only after all records are yielded, so that an
+	error in the middle does not leave a partial file.
+
+	columnar_format: 'parquet' or 'arrow' (Arrow IPC file).
+	"""
+	if pa is None:
+		logger.error('iter_write_columnar(): pyarrow is not installed')
+		raise ColumnarOutputNotAvailable()
+
+	logger.debug('iter_write_columnar(): {0}, format={1}'.format(file, columnar_format))
+	schema = get_schema()
+	temp_file = file + '.tmp'
+	writer = open_writer(temp_file, columnar_format, schema)
+	try:
+		batch = []
+		for record in records:
+			batch.append(record)
+			yield record
+
+			if len(batch) >= batch_size:
+				writer.write_batch(get_batch(batch, schema))
+				batch = []
+
+		if len(batch) > 0:
+			writer.write_batch(get_batch(batch, schema))
+	except:
+		writer.close()
+		os.remove(temp_file)
+		raise
+
+	writer.close()
+	os.replace(temp_file, file)
+
+
+
+def write_columnar(file, records, columnar_format='parquet', batch_size=10000):
+	"""
+	Write records to the columnar file, see iter_write_columnar().
+	"""
+	for record in iter_write_columnar(records, file, columnar_format, batch_size):
+		pass
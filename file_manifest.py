@@ -0,0 +1,188 @@
+# coding=utf-8
+#
+# Keep a manifest of the trade files converted in a folder, so that an
+# incremental run converts only the files that are new or modified since
+# the last run. The manifest is a json file in the folder, like
+#
+# {"trade1.xls": {"size": 23552, "mtime": 1489737600.0, "hash": "3f7a...",
+#	"keys": ["12307_...", ...]}, ...}
+#
+# where "keys" are the key values of the records converted from the file.
+# A file with the same content as another file in the manifest is not
+# converted, its entry has "duplicate_of" instead, which is the name of
+# that file.
+#
+
+from trade_converter.utility import logger, config
+from trade_converter.workbook_reader import get_file_hash
+import json, os
+
+
+
+def get_manifest_file(folder):
+	"""
+	The manifest file of the folder, see "manifest" in the [output] section
+	of the config file.
+	"""
+	name = config.get('output', 'manifest', fallback='tc_manifest.json').strip()
+	return os.path.join(folder, name)
+
+
+
+def load_manifest(manifest_file):
+	"""
+	Return the manifest as a dictionary, an empty one if the file does not
+	exist yet, i.e., the first incremental run on the folder.
+	"""
+	if not os.path.exists(manifest_file):
+		logger.debug('load_manifest(): {0} not found'.format(manifest_file))
+		return {}
+
+	with open(manifest_file) as f:
+		return json.load(f)
+
+
+
+def save_manifest(manifest_file, manifest):
+	"""
+	Save the manifest, write to a temporary file first so that the old
+	manifest is kept if anything goes wrong.
+	"""
+	logger.debug('save_manifest(): {0}, {1} files'.format(manifest_file, len(manifest)))
+	temp_file = manifest_file + '.tmp'
+	with open(temp_file, 'w') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	os.replace(temp_file, manifest_file)
+
+
+
+def find_changed_files(files, manifest):
+	"""
+	Return a tuple (changed, duplicates), changed being the list of
+	(file, file_hash) for files that are new or modified since they are
+	last put into the manifest, duplicates being the list of (file, name)
+	for new or modified files with the same content as another file, whose
+	name is in the manifest or in the changed list. Duplicate files are put
+	into the manifest with no keys, so they are not reported again.
+
+	A file whose size and modification time are unchanged is not hashed. If
+	only the modification time changes but the content is the same, e.g.,
+	the file is copied again, it is not converted, its modification time is
+	updated in the manifest.
+	"""
+	known_hashes = {}
+	for name, entry in manifest.items():
+		if not 'duplicate_of' in entry:
+			known_hashes[entry['hash']] = name
+
+	changed = []
+	duplicates = []
+	for file in files:
+		stat = os.stat(file)
+		name = os.path.basename(file)
+		entry = manifest.get(name)
+		if not entry is None and entry['size'] == stat.st_size \
+			and entry['mtime'] == stat.st_mtime:
+			continue
+
+		file_hash = get_file_hash(file)
+		if not entry is None and entry['hash'] == file_hash:
+			entry['size'] = stat.st_size
+			entry['mtime'] = stat.st_mtime
+			continue
+
+		original = known_hashes.get(file_hash)
+		if not original is None and original != name:
+			logger.warning('find_changed_files(): {0} is the same as {1}, skipped'.
+							format(file, original))
+			duplicates.append((file, original))
+			manifest[name] = {
+				'size': stat.st_size,
+				'mtime': stat.st_mtime,
+				'hash': file_hash,
+				'keys': [],
+				'duplicate_of': original
+			}
+			continue
+
+		known_hashes[file_hash] = name
+		changed.append((file, file_hash))
+
+	logger.debug('find_changed_files(): {0} files, {1} new or modified, {2} duplicates'.
+					format(len(files), len(changed), len(duplicates)))
+	return changed, duplicates
+
+
+
+def remove_duplicate_files(files):
+	"""
+	Return a tuple (unique_files, duplicates), unique_files being the files
+	whose content is different from all files before them in the list,
+	duplicates being the list of (file, original_file) for the rest.
+
+	Only files of the same size are hashed and compared.
+	"""
+	size_count = {}
+	for file in files:
+		size = os.path.getsize(file)
+		size_count[size] = size_count.get(size, 0) + 1
+
+	known_hashes = {}
+	unique_files = []
+	duplicates = []
+	for file in files:
+		if size_count[os.path.getsize(file)] == 1:
+			unique_files.append(file)
+			continue
+
+		file_hash = get_file_hash(file)
+		if file_hash in known_hashes:
+			logger.warning('remove_duplicate_files(): {0} is the same as {1}, skipped'.
+							format(file, known_hashes[file_hash]))
+			duplicates.append((file, known_hashes[file_hash]))
+		else:
+			known_hashes[file_hash] = file
+			unique_files.append(file)
+
+	return unique_files, duplicates
+
+
+
+def get_reserved_keys(manifest, files):
+	"""
+	Return the set of key values of all files in the manifest, except the
+	files given, which are to be converted again. Files removed from the
+	folder are included, as their records have been uploaded already.
+	"""
+	names = set(os.path.basename(file) for file in files)
+	keys = set()
+	for name, entry in manifest.items():
+		if not name in names:
+			keys.update(entry['keys'])
+
+	return keys
+
+
+
+def update_manifest(manifest, changed_files, records, record_sources):
+	"""
+	Put the converted files and the key values of their records into the
+	manifest.
+
+	changed_files: the list of (file, file_hash) from find_changed_files().
+
+	record_sources: the trade file of each record, see the record_sources
+	parameter of the converters, e.g., port_12307.convert12307().
+	"""
+	keys = {}
+	for record, file in zip(records, record_sources):
+		keys.setdefault(file, []).append(record['KeyValue'])
+
+	for file, file_hash in changed_files:
+		stat = os.stat(file)
+		manifest[os.path.basename(file)] = {
+			'size': stat.st_size,
+			'mtime': stat.st_mtime,
+			'hash': file_hash,
+			'keys': keys.get(file, [])
+		}
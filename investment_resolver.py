@@ -0,0 +1,82 @@
+# coding=utf-8
+#
+# Resolve Geneva investment ids in batch. A security traded many times
+# is looked up only once, and securities that cannot be found are also
+# remembered, so that all of them can be reported in one go.
+#
+
+from trade_converter.utility import logger
+from investment_lookup.id_lookup import get_investment_Ids
+
+
+
+# initialized only once when this module is first imported by others
+if not 'resolved' in globals():
+	# (portfolio_id, id_type, security_id) -> investment id, or None
+	# if the security cannot be found.
+	resolved = {}
+
+
+
+# errors from get_investment_Ids() meaning the security is not in the
+# lookup, i.e., no such key, or an empty list of investment ids. Any other
+# error, e.g., the lookup file cannot be read, is passed to the caller.
+not_found_errors = (KeyError, IndexError)
+
+
+
+def resolve_investment_ids(keys):
+	"""
+	Look up the investment id for each distinct key in the list of keys,
+	where a key is a tuple (portfolio_id, id_type, security_id), id_type
+	being 'ISIN', 'SEDOL' or 'CUSIP'. Keys already resolved are not looked
+	up again.
+
+	Return the list of keys that cannot be resolved, in the order they
+	first appear. A lookup error other than not_found_errors is raised,
+	and the key is not marked as resolved.
+	"""
+	global resolved
+	unresolved = []
+	checked = set()
+	for key in keys:
+		if key in checked:
+			continue
+
+		checked.add(key)
+		if not key in resolved:
+			try:
+				resolved[key] = get_investment_Ids(key[0], key[1], key[2])[0]
+			except not_found_errors:
+				logger.error('resolve_investment_ids(): investment id not found for portfolio {0}, {1} {2}'.
+								format(key[0], key[1], key[2]))
+				resolved[key] = None
+
+		if resolved[key] is None:
+			unresolved.append(key)
+
+	return unresolved
+
+
+
+def get_investment_id(portfolio_id, id_type, security_id):
+	"""
+	Return the investment id of the security, resolving it if it is not
+	done yet. Return None if the security cannot be found.
+	"""
+	global resolved
+	key = (portfolio_id, id_type, security_id)
+	if not key in resolved:
+		resolve_investment_ids([key])
+
+	return resolved[key]
+
+
+
+def clear_resolved_ids():
+	"""
+	Forget all resolved investment ids, e.g., after the lookup data is
+	updated.
+	"""
+	global resolved
+	resolved.clear()
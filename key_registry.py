@@ -0,0 +1,124 @@
+# coding=utf-8
+#
+# Keep the key values assigned to trades in a local SQLite file, so that
+# when the same trade files are converted again, a trade gets back the
+# same key value, and only new trades get new key values.
+#
+
+from trade_converter.utility import logger, get_record_fields
+import sqlite3, hashlib
+
+
+
+def open_key_registry(registry_file):
+	"""
+	Open the registry file, create the table if it does not exist yet.
+	"""
+	logger.debug('open_key_registry(): {0}'.format(registry_file))
+	conn = sqlite3.connect(registry_file)
+	conn.execute('CREATE TABLE IF NOT EXISTS key_registry \
+					(fingerprint TEXT PRIMARY KEY, key_value TEXT NOT NULL UNIQUE)')
+	return conn
+
+
+
+def get_fingerprint(record):
+	"""
+	The content fingerprint of a record, i.e., a hash of all its fields
+	except the key value and UserTranId1.
+	"""
+	content = []
+	for fld in get_record_fields():
+		if not fld in ['KeyValue', 'UserTranId1']:
+			content.append(repr(record.get(fld)))
+
+	# add the key value as well, it has not been de-duplicated yet.
+	content.append(record['KeyValue'])
+	return hashlib.sha1('|'.join(content).encode('utf-8')).hexdigest()
+
+
+
+def assign_registered_keys(records, registry_file):
+	"""
+	Assign a unique key value to each record, which is the same key value
+	assigned to the same trade in previous runs.
+
+	records: Geneva records whose key values are not de-duplicated yet.
+
+	Identical records in the same run are told apart by the order in which
+	they appear, i.e., the 2nd identical record gets the same key value as
+	the 2nd one in previous runs. A record not in the registry yet gets its
+	key value, or the key value with a suffix '_1', '_2', etc., the first
+	one not used by any record in the registry, then it is added to the
+	registry.
+	"""
+	for record in iter_registered_keys(records, registry_file):
+		pass
+
+
+
+def iter_registered_keys(records, registry_file):
+	"""
+	A generator version of assign_registered_keys(), it takes an iterable
+	of records and yields them one by one after assigning key values. New
+	keys are saved to the registry when all records are done.
+	"""
+	conn = open_key_registry(registry_file)
+	try:
+		occurrence = {}
+		next_suffix = {}
+		new_entries = []
+		new_keys = set()
+		count = 0
+		for record in records:
+			fingerprint = get_fingerprint(record)
+			n = occurrence.get(fingerprint, 0)
+			occurrence[fingerprint] = n + 1
+			fingerprint = fingerprint + '_' + str(n)
+
+			row = conn.execute('SELECT key_value FROM key_registry WHERE fingerprint=?',
+								(fingerprint,)).fetchone()
+			if row is None:
+				key_value = find_unused_key(conn, record['KeyValue'], new_keys, next_suffix)
+				new_keys.add(key_value)
+				new_entries.append((fingerprint, key_value))
+			else:
+				key_value = row[0]
+
+			record['KeyValue'] = key_value
+			record['UserTranId1'] = key_value
+			count = count + 1
+			yield record
+
+		logger.debug('iter_registered_keys(): {0} records, {1} new keys'.
+						format(count, len(new_entries)))
+		conn.executemany('INSERT INTO key_registry (fingerprint, key_value) VALUES (?, ?)',
+							new_entries)
+		conn.commit()
+	finally:
+		conn.close()
+
+
+
+def find_unused_key(conn, key_value, new_keys, next_suffix):
+	"""
+	Return the key value, or the key value with a suffix, which is not used
+	in the registry or by the new keys assigned in this run.
+	"""
+	temp_key = key_value
+	i = next_suffix.get(key_value, 1)
+	while temp_key in new_keys or is_registered_key(conn, temp_key):
+		temp_key = key_value + '_' + str(i)
+		i = i + 1
+
+	if temp_key != key_value:
+		next_suffix[key_value] = i
+
+	return temp_key
+
+
+
+def is_registered_key(conn, key_value):
+	row = conn.execute('SELECT 1 FROM key_registry WHERE key_value=?',
+						(key_value,)).fetchone()
+	return not row is None
@@ -3,12 +3,26 @@
 # Open trade files of portfolio 12307 and convert them to a single file in a
 # format required by Advent Geneva system for quick import.
 # 
+# To time fix_duplicate_key_value() on many records sharing a few key
+# values, run
+#
+#	python port_12307.py <number of records> <number of key values>
+#
 
-from trade_converter.utility import logger, get_datemode, get_record_fields, \
+from trade_converter.utility import logger, trace, get_record_fields, \
 									get_current_path, convert_datetime_to_string, \
-									is_blank_line, is_empty_cell
+									is_blank_line, is_empty_cell, read_row_values, \
+									get_column_converters, float_to_string, \
+									get_key_registry_file, map_files, \
+									get_cached_date, excel_date_to_datetime
+from trade_converter.key_registry import iter_registered_keys
+from trade_converter.workbook_reader import open_worksheet, close_worksheet
+from trade_converter.record_types import get_row_type, get_record_type, \
+										compile_record_builder
+from trade_converter.batch_validation import use_batch_validation, \
+										validate_12307_trades, check_trades
 from xlrd import open_workbook
-from xlrd.xldate import xldate_as_datetime
+import time
 
 
 
@@ -23,44 +37,102 @@ class InvalidTradeInfo(Exception):
 
 
 
-def convert12307(files):
+def convert12307(files, jobs=1, reserved_keys=None, record_sources=None):
 	"""
 	Convert the trade files of portfolio 12307 to Geneva format for quick 
 	import.
 
 	files: a list of trade files.
+
+	jobs: number of processes to read the files in parallel.
+
+	reserved_keys: key values already used, see fix_duplicate_key_value().
+
+	record_sources: if a list is given, the trade file of each record is
+	appended to it, in the same order as the records.
 	"""
 	logger.debug('in convert12307()')
 
 	output = []
-	for f in files:
-		read_trade_file(f, output)
+	for f, trades in zip(files, map_files(read_trade_file, files, jobs)):
+		output.extend(trades)
+		if not record_sources is None:
+			record_sources.extend([f]*len(trades))
 
 	records = convert_to_geneva_records(output)
-	fix_duplicate_key_value(records)
+	fix_duplicate_key_value(records, reserved_keys=reserved_keys)
 
 	return records
 
 
 
-def read_trade_file(trade_file, output):
-	logger.debug('read_trade_file(): {0}'.format(trade_file))
+def iter_convert12307(files):
+	"""
+	Same as convert12307(), but as a generator that yields the records one
+	by one, so that the files are read and records written at the same
+	time, without keeping all of them in memory.
+	"""
+	logger.debug('in iter_convert12307()')
+
+	record_fields = get_record_fields()
+	records = (create_record(trade_info, record_fields) \
+				for f in files for trade_info in iter_trade_file(f))
+
+	return iter_unique_keys(records)
+
+
+
+def read_trade_file(trade_file, output=None):
+	"""
+	Read the trades in the file, append them to the output list. If output
+	is not given, a new list is created.
+
+	Return the output list.
+
+	If batch validation is used (see batch_validation.py), all trades of
+	the file are validated after they are read.
+	"""
+	if output is None:
+		output = []
+
+	if use_batch_validation():
+		trades = list(iter_trade_file(trade_file, validate=False))
+		if check_trades(trades, validate_12307_trades, ['Trd Dt', 'ISIN', 'B/S'], trade_file) > 0:
+			raise InvalidTradeInfo()
+		output.extend(trades)
+	else:
+		output.extend(iter_trade_file(trade_file))
+
+	return output
 
-	wb = open_workbook(filename=trade_file)
-	ws = wb.sheet_by_index(0)
+
+
+def iter_trade_file(trade_file, validate=True):
+	"""
+	A generator that reads the trades in the file and yields them one by
+	one, after validation if validate is True.
+	"""
+	logger.debug('iter_trade_file(): {0}'.format(trade_file))
+
+	ws = open_worksheet(trade_file)
 	row = 0
 
 	while not data_field_begins(ws, row):
 		row = row + 1
 
 	fields = read_data_fields(ws, row)
+	converters = get_converters(fields)
 	row = row + 1
 
-	while not is_blank_line(ws, row):
-		trade_info = read_line(ws, row, fields)
-		validate_trade_info(trade_info)
-		output.append(trade_info)
-		row = row + 1
+	try:
+		while row < ws.nrows and not is_blank_line(ws, row):
+			trade_info = read_line(ws, row, fields, converters)
+			if validate:
+				validate_trade_info(trade_info)
+			yield trade_info
+			row = row + 1
+	finally:
+		close_worksheet(ws)
 
 
 
@@ -79,36 +151,49 @@ def read_data_fields(ws, row):
 
 
 
-def read_line(ws, row, fields):
+def get_converters(fields):
 	"""
-	Read the trade information from a line.
+	Create the column converters for a trade file, based on its data
+	fields.
 	"""
-	trade_info = {}
-	column = 0
+	def convert_date(cell_value):
+		return get_cached_date(cell_value, excel_date_to_datetime)
+
+	converter_map = {
+		'Acct#':float_to_string,
+		'Trade#':float_to_string,
+		'Trd Dt':convert_date,
+		'Setl Dt':convert_date
+	}
 
-	for fld in fields:
-		logger.debug('read_line(): row={0}, column={1}'.format(row, column))
+	return get_column_converters(fields, converter_map)
 
-		cell_value = ws.cell_value(row, column)
-		if isinstance(cell_value, str):
-			cell_value = cell_value.strip()
 
-		if fld in ['Acct#', 'Trade#'] and isinstance(cell_value, float):
-			cell_value = str(int(cell_value))
-		elif fld in ['Trd Dt', 'Setl Dt']:
-			cell_value = xldate_as_datetime(cell_value, get_datemode())
 
-		trade_info[fld] = cell_value
-		column = column + 1
-	# end of for loop
+def read_line(ws, row, fields, converters=None):
+	"""
+	Read the trade information from a line.
+
+	converters: the column converters from get_converters(fields), if not
+	given, they are created from the fields.
+
+	The trade information is a row of get_row_type(fields), with every
+	column of the line.
+	"""
+	trace('read_line(): row=%s', row)
 
-	return trade_info
+	if converters is None:
+		converters = get_converters(fields)
+
+	values = read_row_values(ws, row, len(fields))
+	return get_row_type(fields)(*[convert(cell_value) for convert, cell_value \
+									in zip(converters, values)])
 
 
 
 def validate_trade_info(trade_info):
-	logger.debug('validate_trade_info(): trade date={0}, isin={1}'.
-					format(trade_info['Trd Dt'], trade_info['ISIN']))
+	trace('validate_trade_info(): trade date=%s, isin=%s',
+			trade_info['Trd Dt'], trade_info['ISIN'])
 	
 	# if trade_info['Acct#'] != '12307':
 	# 	logger.error('validate_trade_info(): invalid portfolio code: {0}'.format(trade_info['Acct#']))
@@ -135,32 +220,99 @@ def validate_trade_info(trade_info):
 
 
 
-def fix_duplicate_key_value(records):
+def fix_duplicate_key_value(records, registry_file=None, reserved_keys=None):
 	"""
 	Detect whether there are duplicate keyvalues for different records,
 	if there are, modify the keyvalues to make all keys unique.
+
+	A duplicate key gets a suffix '_1', '_2', etc., the first one not
+	used yet. Keys are kept in a set and the next suffix to try for each
+	key is remembered, so it runs in linear time even when many records
+	share the same key.
+
+	registry_file: the key registry file (see key_registry.py), if not
+	given, use the one in the config file. If there is a key registry,
+	records get the same key values as they get in previous runs.
+
+	reserved_keys: key values already used by records uploaded before,
+	e.g., in an incremental run (see file_manifest.py), a record does not
+	get any of them. Not used when there is a key registry, because the
+	registry already has all key values assigned before.
 	"""
-	keys = []
-	for record in records:
-		i = 1
-		temp_key = record['KeyValue']
-		while temp_key in keys:
-			temp_key = record['KeyValue'] + '_' + str(i)
-			i = i + 1
+	for record in iter_unique_keys(records, registry_file, reserved_keys):
+		pass
+
+
+
+def iter_unique_keys(records, registry_file=None, reserved_keys=None):
+	"""
+	A generator version of fix_duplicate_key_value(), it takes an iterable
+	of records and yields them one by one after fixing their key values.
+	Only the keys are kept in memory, not the records.
+	"""
+	if registry_file is None:
+		registry_file = get_key_registry_file()
 
-		record['KeyValue'] = temp_key
-		record['UserTranId1'] = temp_key
-		keys.append(record['KeyValue'])
+	if registry_file != '':
+		records = iter_registered_keys(records, registry_file)
+	else:
+		records = iter_suffixed_keys(records, reserved_keys)
 
 	# check again
-	keys = []
+	keys = set()
+	record_type = get_record_type()
 	for record in records:
-		if record['KeyValue'] in keys:
+		if type(record) is record_type:
+			key_value = record.KeyValue
+		else:
+			key_value = record['KeyValue']
+
+		if key_value in keys:
 			logger.error('fix_duplicate_key_value(): duplicate keys still exists, key={0}, investment={1}'.
-							format(record['KeyValue'], record['Investment']))
+							format(key_value, record['Investment']))
 			raise DuplicateKeys()
 
-		keys.append(record['KeyValue'])
+		keys.add(key_value)
+		yield record
+
+
+
+def iter_suffixed_keys(records, reserved_keys=None):
+	if reserved_keys is None:
+		keys = set()
+	else:
+		keys = set(reserved_keys)
+
+	# Geneva records (see record_types.py) are accessed by attribute, which
+	# is faster than record['KeyValue'], other records, e.g., dictionaries,
+	# by key.
+	next_suffix = {}
+	record_type = get_record_type()
+	for record in records:
+		is_row = type(record) is record_type
+		if is_row:
+			key_value = record.KeyValue
+		else:
+			key_value = record['KeyValue']
+
+		temp_key = key_value
+		if temp_key in keys:
+			i = next_suffix.get(key_value, 1)
+			while temp_key in keys:
+				temp_key = key_value + '_' + str(i)
+				i = i + 1
+
+			next_suffix[key_value] = i
+
+		if is_row:
+			record.KeyValue = temp_key
+			record.UserTranId1 = temp_key
+		else:
+			record['KeyValue'] = temp_key
+			record['UserTranId1'] = temp_key
+
+		keys.add(temp_key)
+		yield record
 
 
 
@@ -218,62 +370,54 @@ def map_broker_code(broker_code):
 
 
 
-def create_record(trade_info, record_fields):
-	# print(trade_info['Trd Dt'])
-	known_fields = {
-		'RecordAction':'InsertUpdate',
-		'KeyValue.KeyName':'UserTranId1',
-		'LocationAccount':'JPM',
-		'Strategy':'Default',
-		'PriceDenomination':'CALC',
-		'NetInvestmentAmount':'CALC',
-		'NetCounterAmount':'CALC',
-		'TradeFX':'',
-		'NotionalAmount':'CALC',
-		'FundStructure':'CALC',
-		'CounterFXDenomination':'USD',
-		'CounterTDateFx':'',
-		'AccruedInterest':'CALC',
-		'InvestmentAccruedInterest':'CALC'
-	}
-	
-	trade_type = {'B':'Buy', 'S':'Sell'}
+# The Geneva record of a trade is built from the constant fields and the
+# field extractors below, see create_record().
+record_known_fields = {
+	'RecordAction':'InsertUpdate',
+	'KeyValue.KeyName':'UserTranId1',
+	'LocationAccount':'JPM',
+	'Strategy':'Default',
+	'PriceDenomination':'CALC',
+	'NetInvestmentAmount':'CALC',
+	'NetCounterAmount':'CALC',
+	'TradeFX':'',
+	'NotionalAmount':'CALC',
+	'FundStructure':'CALC',
+	'CounterFXDenomination':'USD',
+	'CounterTDateFx':'',
+	'AccruedInterest':'CALC',
+	'InvestmentAccruedInterest':'CALC'
+}
+
+record_trade_type = {'B':'Buy', 'S':'Sell'}
+
+record_extractors = {
+	'RecordType':lambda trade_info, record: record_trade_type[trade_info['B/S']],
+	'KeyValue':lambda trade_info, record: create_record_key_value(trade_info),
+	'UserTranId1':lambda trade_info, record: record.KeyValue,
+	'Portfolio':lambda trade_info, record: trade_info['Acct#'],
+	'Investment':lambda trade_info, record: get_geneva_investment_id(trade_info)[1],
+	'Broker':lambda trade_info, record: map_broker_code(trade_info['BrkCd']),
+	'EventDate':lambda trade_info, record: convert_datetime_to_string(trade_info['Trd Dt']),
+	'SettleDate':lambda trade_info, record: convert_datetime_to_string(trade_info['Setl Dt']),
+	'ActualSettleDate':lambda trade_info, record: record.SettleDate,
+	'Quantity':lambda trade_info, record: trade_info['Units'],
+	'Price':lambda trade_info, record: trade_info['Unit Price'],
+	'CounterInvestment':lambda trade_info, record: trade_info['Cur'],
+	'trade_expenses':lambda trade_info, record: get_trade_expenses(trade_info)
+}
+
+build_record = compile_record_builder(record_known_fields, record_extractors)
+
+
+
+def create_record(trade_info, record_fields=None):
+	"""
+	Create the Geneva record of the trade.
 
-	new_record = {}
-	for record_field in record_fields:
-
-		if record_field in known_fields:
-			new_record[record_field] = known_fields[record_field]
-
-		if record_field == 'RecordType':
-			new_record[record_field] = trade_type[trade_info['B/S']]
-		elif record_field == 'KeyValue':
-			new_record[record_field] = create_record_key_value(trade_info)
-		elif record_field == 'UserTranId1':
-			new_record[record_field] = new_record['KeyValue']
-		elif record_field == 'Portfolio':
-			new_record[record_field] = trade_info['Acct#']
-		elif record_field == 'Investment':
-			new_record[record_field] = get_geneva_investment_id(trade_info)[1]
-		elif record_field == 'Broker':
-			new_record[record_field] = map_broker_code(trade_info['BrkCd'])
-		elif record_field == 'EventDate':
-			new_record[record_field] = convert_datetime_to_string(trade_info['Trd Dt'])
-		elif record_field == 'SettleDate':
-			new_record[record_field] = convert_datetime_to_string(trade_info['Setl Dt'])
-		elif record_field == 'ActualSettleDate':
-			new_record[record_field] = new_record['SettleDate']
-		elif record_field == 'Quantity':
-			new_record[record_field] = trade_info['Units']
-		elif record_field == 'Price':
-			new_record[record_field] = trade_info['Unit Price']
-		elif record_field == 'CounterInvestment':
-			new_record[record_field] = trade_info['Cur']
-		elif record_field == 'trade_expenses':
-			new_record[record_field] = get_trade_expenses(trade_info)
-	# end of for loop
-
-	return new_record
+	record_fields: not used, the record fields are always get_record_fields().
+	"""
+	return build_record(trade_info)
 
 
 
@@ -301,7 +445,7 @@ def get_geneva_investment_id(trade_info):
 		initialize_investment_lookup(investment_lookup, lookup_file)
 
 	# return (name, investment_id)
-	logger.debug('get_geneva_investment_id(): trade date {0}'.format(trade_info['Trd Dt']))
+	trace('get_geneva_investment_id(): trade date %s', trade_info['Trd Dt'])
 	return investment_lookup[trade_info['ISIN']]
 
 
@@ -373,7 +517,7 @@ def create_record_key_value(trade_info):
 
 
 def data_field_begins(ws, row):
-	logger.debug('in data_field_begins()')
+	trace('data_field_begins(): row=%s', row)
 	
 	cell_value = ws.cell_value(row, 0)
 	if isinstance(cell_value, str) and cell_value.strip() == 'Acct#':
@@ -381,3 +525,22 @@ def data_field_begins(ws, row):
 	else:
 		return False
 
+
+
+def benchmark_duplicate_keys(n=500000, keys=1000):
+	"""
+	Run fix_duplicate_key_value() on n records sharing the given number of
+	key values, print and return the time taken in seconds.
+	"""
+	records = [{'KeyValue':'x{0}'.format(i%keys), 'Investment':''} for i in range(n)]
+	start = time.perf_counter()
+	fix_duplicate_key_value(records)
+	elapsed = time.perf_counter() - start
+	print('{0} records, {1} key values: {2:.3f} seconds'.format(n, keys, elapsed))
+	return elapsed
+
+
+
+if __name__ == '__main__':
+	import sys
+	benchmark_duplicate_keys(*[int(arg) for arg in sys.argv[1:3]])
@@ -3,12 +3,14 @@
 # Open transaction files from settlement for bond portfolio 12734 and convert 
 # them to Geneva trade upload format.
 #
-from trade_converter.utility import logger, get_record_fields, \
+from trade_converter.utility import logger, trace, get_record_fields, \
 									get_input_directory, \
-									convert_datetime_to_string
+									convert_datetime_to_string, read_row_values, \
+									get_column_converters, map_files, get_cached_date
 from trade_converter.port_12307 import convert_to_geneva_records, \
-									fix_duplicate_key_value
+									fix_duplicate_key_value, iter_unique_keys
 from small_program.read_file import read_file
+from trade_converter.record_types import empty_record
 from xlrd.xldate import xldate_as_datetime
 from datetime import datetime, timedelta
 import csv
@@ -23,21 +25,27 @@ class ISINMapFailure(Exception):
 
 
 
-def convert12734(files):
+def convert12734(files, jobs=1, reserved_keys=None, record_sources=None):
 	"""
 	Convert the trade files from settlement to Geneva format for quick trade
 	import.
 
 	files: a list of trade files.
+
+	jobs: number of processes to read the files in parallel.
+
+	reserved_keys, record_sources: see port_12307.convert12307().
 	"""
 	output_list = []
 	error_list = []
-	for f in files:
-		logger.debug('convert12734(): read file {0}'.format(f))
-		read_transaction_file(f, output_list, error_list)
+	for f, (output, row_in_error) in zip(files, map_files(read_transaction_file, files, jobs)):
+		output_list.extend(output)
+		error_list.extend(row_in_error)
+		if not record_sources is None:
+			record_sources.extend([f]*len(output))
 
 	records = convert_to_geneva_records(output_list)
-	fix_duplicate_key_value(records)
+	fix_duplicate_key_value(records, reserved_keys=reserved_keys)
 
 	if len(error_list) > 0:
 		print('There are {0} rows in error, check log file'.format(len(error_list)))
@@ -46,11 +54,45 @@ def convert12734(files):
 
 
 
-def read_transaction_file(file, output_list, error_list):
+def iter_convert12734(files):
+	"""
+	Same as convert12734(), but as a generator that yields the records one
+	by one. Note each file is still read as a whole, by read_file().
+	"""
+	record_fields = get_record_fields()
+
+	def iter_records():
+		error_count = 0
+		for f in files:
+			output, row_in_error = read_transaction_file(f)
+			error_count = error_count + len(row_in_error)
+			for trade_info in output:
+				yield create_record(trade_info, record_fields)
+
+		if error_count > 0:
+			print('There are {0} rows in error, check log file'.format(error_count))
+
+	return iter_unique_keys(iter_records())
+
+
+
+def read_transaction_file(file, output_list=None, error_list=None):
+	"""
+	Read the file, append the lines read to output_list and lines in error
+	to error_list. If the lists are not given, new lists are created.
+
+	Return (output_list, error_list).
+	"""
 	logger.debug('read_transaction_file(): read file: {0}'.format(file))
+	if output_list is None:
+		output_list = []
+	if error_list is None:
+		error_list = []
+
 	output, row_in_errow = read_file(file, read_line, validate_line, 13)
 	output_list.extend(output)
 	error_list.extend(row_in_errow)
+	return output_list, error_list
 
 
 
@@ -80,34 +122,61 @@ def validate_line(line_info):
 
 
 
-def read_line(ws, row, fields):
+def get_converters(fields):
 	"""
-	Read the trade information from a line.
+	Create the column converters for a transaction file, based on its data
+	fields.
+
+	As read_line() is called by read_file() with the fields only, the
+	converters are created once for the same fields and then reused.
 	"""
-	line_info = {}
-	column = 0
+	if 'converters' not in get_converters.__dict__:
+		get_converters.converters = {}
+
+	key = tuple(fields)
+	if not key in get_converters.converters:
+		converter_map = {
+			'Item No.':int,
+			'Security Code':convert_security_code,
+			'Trade Date':convert_date,
+			'Value Date':convert_date
+		}
+		get_converters.converters[key] = get_column_converters(fields, converter_map)
+
+	return get_converters.converters[key]
+
+
+
+def convert_security_code(cell_value):
+	if isinstance(cell_value, float):
+		cell_value = str(int(cell_value))
+	if not is_valid_isin(cell_value):
+		cell_value = map_to_isin(cell_value)
+
+	return cell_value
+
+
 
-	for fld in fields:
-		logger.debug('read_line(): row={0}, column={1}'.format(row, column))
+def convert_date(cell_value):
+	return get_cached_date(cell_value, decode_date)
 
-		cell_value = ws.cell_value(row, column)
-		if isinstance(cell_value, str):
-			cell_value = cell_value.strip()
 
-		if fld == 'Item No.':
-			cell_value = int(cell_value)
 
-		if fld == 'Security Code':
-			if isinstance(cell_value, float):
-				cell_value = str(int(cell_value))
-			if not is_valid_isin(cell_value):
-				cell_value = map_to_isin(cell_value)
+def decode_date(cell_value):
+	return xldate_as_datetime(cell_value, 0)
 
-		if fld in ['Trade Date', 'Value Date']:
-			cell_value = xldate_as_datetime(cell_value, 0)
-		
-		line_info[fld] = cell_value
-		column = column + 1
+
+
+def read_line(ws, row, fields):
+	"""
+	Read the trade information from a line.
+	"""
+	trace('read_line(): row=%s', row)
+
+	line_info = {}
+	values = read_row_values(ws, row, len(fields))
+	for fld, convert, cell_value in zip(fields, get_converters(fields), values):
+		line_info[fld] = convert(cell_value)
 
 	return line_info
 
@@ -194,7 +263,7 @@ def create_record(trade_info, record_fields):
 		'trade_expenses':[]
 	}
 
-	new_record = {}
+	new_record = empty_record()
 	for fld in known_fields:
 		new_record[fld] = known_fields[fld]
 
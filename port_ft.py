@@ -10,16 +10,27 @@
 #		subtracting the total settlement amount and the price*quantity. So
 #		all fees will be put into miscellaneous fees.
 #
-from trade_converter.utility import logger, get_datemode, get_record_fields, \
+from trade_converter.utility import logger, trace, get_record_fields, \
 									get_current_path, convert_datetime_to_string, \
-									is_blank_line, is_empty_cell, get_input_directory
+									is_blank_line, is_empty_cell, get_input_directory, \
+									read_row_values, get_column_converters, \
+									float_to_string, combine_converters, \
+									get_type_checker, get_row_filter, map_files, \
+									config, get_cached_date, excel_date_to_datetime, \
+									mmddyyyy_to_datetime
 from trade_converter.port_12307 import convert_to_geneva_records, \
-									fix_duplicate_key_value
-from xlrd import open_workbook
-from xlrd.xldate import xldate_as_datetime
+									fix_duplicate_key_value, iter_unique_keys
+from trade_converter.workbook_reader import open_worksheet, close_worksheet
+from trade_converter.record_types import get_row_type, compile_record_builder
+from trade_converter.batch_validation import use_batch_validation, \
+										validate_ft_trades, check_trades
 from datetime import datetime
-from investment_lookup.id_lookup import get_investment_Ids, \
-										get_portfolio_accounting_treatment
+from trade_converter.portfolio_cache import get_portfolio_info, \
+										get_accounting_treatment
+from trade_converter.investment_resolver import resolve_investment_ids, \
+										get_investment_id
+from functools import partial
+from collections import Counter
 import csv
 
 
@@ -33,6 +44,9 @@ class InvalidTradeInfo(Exception):
 class LocationAccountNotFound(Exception):
 	pass
 
+class InvalidDuplicatePolicy(Exception):
+	pass
+
 class PortfolioCurrencyNotFound(Exception):
 	pass
 
@@ -44,56 +58,225 @@ class TradeExpenseNotHandled(Exception):
 
 
 
-def convert_ft(files):
+def convert_ft(files, predicates=None, jobs=1, reserved_keys=None, record_sources=None,
+				duplicate_policy=None):
 	"""
 	Convert the trade files from FT to Geneva format for quick trade
 	import.
 
 	files: a list of trade files.
+
+	predicates: optional row filters, see read_transaction_file().
+
+	jobs: number of processes to read the files in parallel. If more than
+	1, the predicates must be picklable (module level functions).
+
+	reserved_keys, record_sources: see port_12307.convert12307().
+
+	duplicate_policy: what to do with the same trade appearing again in
+	the files, see iter_unique_trades().
 	"""
 	logger.debug('in convert_ft()')
 
 	output = []
-	for f in files:
-		read_transaction_file(f, output)
+	fingerprints = Counter()
+	read_file = partial(read_transaction_file, output=None, predicates=predicates)
+	for f, trades in zip(files, map_files(read_file, files, jobs)):
+		trades = list(iter_unique_trades(trades, duplicate_policy, fingerprints))
+		output.extend(trades)
+		if not record_sources is None:
+			record_sources.extend([f]*len(trades))
 
 	create_geneva_flat_file(output)
 
 	records = convert_to_geneva_records(output)
-	fix_duplicate_key_value(records)
+	fix_duplicate_key_value(records, reserved_keys=reserved_keys)
 
 	return records
 
 
 
-def read_transaction_file(trade_file, output):
+def iter_convert_ft(files, predicates=None, duplicate_policy=None):
+	"""
+	Same as convert_ft(), but as a generator that yields the records one
+	by one, so that the files are read and records written at the same
+	time, without keeping all of them in memory. Trades are read one file
+	at a time, so that the investment ids of a file are resolved in one
+	pass (see check_investment_ids()) before its records are yielded.
+
+	The bond master flat file is written after all records are yielded.
+	"""
+	logger.debug('in iter_convert_ft()')
+
+	isin_list = []
+	isin_set = set()
+	fingerprints = Counter()
+	record_fields = get_record_fields()
+
+	def iter_records():
+		for f in files:
+			trades = list(iter_unique_trades(iter_transaction_file(f, predicates),
+												duplicate_policy, fingerprints))
+			check_investment_ids(trades)
+			for trade_info in trades:
+				add_isin(trade_info, isin_list, isin_set)
+				yield create_record(trade_info, record_fields)
+
+	for record in iter_unique_keys(iter_records()):
+		yield record
+
+	write_flat_file(isin_list)
+
+
+
+def get_duplicate_policy():
+	"""
+	Read the duplicate trade policy from the config object and return it,
+	see iter_unique_trades().
+	"""
+	return config.get('input', 'duplicate_trades', fallback='keep').strip()
+
+
+
+def get_trade_fingerprint(trade_info):
+	"""
+	The fields that identify a trade, two trades with the same fingerprint
+	are the same trade, e.g., from overlapping monthly and quarterly files.
+	"""
+	return (trade_info['ACCT_ACNO'], trade_info['TRDDATE'], trade_info['TRANTYP'],
+			trade_info['SCTYID_ISIN'], trade_info['QTY'], trade_info['PRINB'],
+			trade_info['ENTRDATE'])
+
+
+
+def iter_unique_trades(trades, policy=None, fingerprints=None):
+	"""
+	Yield the trades of a file. A trade is a repeat if trades with the
+	same fingerprint (see get_trade_fingerprint()) in earlier files account
+	for it, e.g., the same trade in overlapping monthly and quarterly files.
+	Trades with the same fingerprint in one file, e.g., split fills, are not
+	repeats of each other. What to do with a repeat depends on the policy:
+
+	1. 'keep': yield it, no check is done. Its key value gets a suffix
+		later, like any other duplicate key.
+	2. 'drop': do not yield it, log a warning.
+	3. 'flag': yield it, log a warning.
+
+	policy: if not given, use the one in the config file.
+
+	fingerprints: a Counter of the fingerprints of trades in earlier files,
+	it is updated when all trades of this file are yielded, so that the
+	check can go across several calls, one call per file.
+
+	For example, if a fingerprint appears twice in an earlier file and
+	three times in this file, the first two are repeats, the third is not.
+	"""
+	if policy is None:
+		policy = get_duplicate_policy()
+
+	if not policy in ['keep', 'drop', 'flag']:
+		logger.error('iter_unique_trades(): invalid policy {0}'.format(policy))
+		raise InvalidDuplicatePolicy()
+
+	if policy == 'keep':
+		for trade_info in trades:
+			yield trade_info
+		return
+
+	if fingerprints is None:
+		fingerprints = Counter()
+
+	file_fingerprints = Counter()
+	for trade_info in trades:
+		fingerprint = get_trade_fingerprint(trade_info)
+		file_fingerprints[fingerprint] = file_fingerprints[fingerprint] + 1
+		if file_fingerprints[fingerprint] <= fingerprints[fingerprint]:
+			logger.warning('iter_unique_trades(): duplicate trade {0}, {1}'.
+							format(fingerprint, policy))
+			if policy == 'drop':
+				continue
+
+		yield trade_info
+
+	for fingerprint, count in file_fingerprints.items():
+		fingerprints[fingerprint] = max(fingerprints[fingerprint], count)
+
+
+
+def read_transaction_file(trade_file, output=None, predicates=None):
 	"""
 	Note: the transaction file from FT contains all kinds of transactions,
 	including purchase/sale, cash movements, position adjustments, paydown,
 	bond exchange offer, called by issuer, FX transactions, etc.
 
-	For simplicity, we filtered out purchase/sale first.
+	For simplicity, we filtered out purchase/sale first. This is done by
+	looking at the TRANTYP column only, before the rest of the row is read.
+
+	predicates: optional, a dictionary mapping a key field (e.g., ACCT_ACNO,
+	SCTYID_ISIN) to a function that takes the field value and returns True
+	if the row should be read, e.g., {'ACCT_ACNO': lambda x: x == '12229'}.
+	Rows not satisfying all predicates are skipped.
+
+	Trades are appended to the output list, if it is not given, a new list
+	is created. Return the output list.
+
+	If batch validation is used (see batch_validation.py), all trades of
+	the file are validated after they are read.
+	"""
+	if output is None:
+		output = []
+
+	if use_batch_validation():
+		trades = list(iter_transaction_file(trade_file, predicates, validate=False))
+		if check_trades(trades, validate_ft_trades, ['ACCT_ACNO', 'TRDDATE', 'SCTYID_ISIN'],
+						trade_file) > 0:
+			raise InvalidTradeInfo()
+		output.extend(trades)
+	else:
+		output.extend(iter_transaction_file(trade_file, predicates))
+
+	return output
+
+
+
+def iter_transaction_file(trade_file, predicates=None, validate=True):
+	"""
+	A generator that reads the purchase/sale trades in the file and yields
+	them one by one, after validation if validate is True. See
+	read_transaction_file().
 	"""
-	logger.debug('read_transaction_file(): {0}'.format(trade_file))
+	logger.debug('iter_transaction_file(): {0}'.format(trade_file))
 
-	wb = open_workbook(filename=trade_file)
-	ws = wb.sheet_by_index(0)
+	ws = open_worksheet(trade_file)
 
 	fields = read_data_fields(ws, 0)
+	converters = get_converters(fields)
+
+	row_predicates = {'TRANTYP':is_purchase_sale}
+	if not predicates is None:
+		row_predicates.update(predicates)
+	keep_row = get_row_filter(fields, converters, row_predicates)
 	
 	row = 1
-	# starting_pos = len(output)
-	while row < ws.nrows:
-		if is_blank_line(ws, row):
-			break
+	try:
+		while row < ws.nrows:
+			if is_blank_line(ws, row):
+				break
+
+			if not keep_row(ws, row):
+				row = row + 1
+				continue
 
-		trade_info = read_line(ws, row, fields)
-		if not trade_info is None:
-			validate_trade_info(trade_info)
-			output.append(trade_info)
+			trade_info = read_line(ws, row, fields, converters)
+			if not trade_info is None:
+				if validate:
+					validate_trade_info(trade_info)
+				yield trade_info
 
-		row = row + 1
-	# end of while loop
+			row = row + 1
+		# end of while loop
+	finally:
+		close_worksheet(ws)
 
 
 
@@ -112,55 +295,97 @@ def read_data_fields(ws, row):
 
 
 
-def read_line(ws, row, fields):
+def get_converters(fields):
 	"""
-	Read the trade information from a line.
+	Create the column converters for a transaction file, based on its data
+	fields. Each converter checks the type of the cell value first (see
+	get_field_types()), then converts it.
+
+	Date fields are only checked here, because how to convert them depends
+	on the portfolio, see get_date_converter().
 	"""
-	trade_info = {}
-	column = 0
+	converter_map = {
+		'ACCT_ACNO':convert_account_number,
+		'SCTYID_SMSEQ':float_to_string,
+		'SCTYID_SEDOL':float_to_string,
+		'SCTYID_CUSIP':float_to_string
+	}
 
-	for fld in fields:
-		logger.debug('read_line(): row={0}, column={1}'.format(row, column))
+	converters = get_column_converters(fields, converter_map)
+	field_types = get_field_types()
+	for column, fld in enumerate(fields):
+		if fld in field_types:
+			check = get_type_checker(fld, field_types[fld], InvalidFieldValue)
+			converters[column] = combine_converters(check, converters[column])
 
-		cell_value = ws.cell_value(row, column)
-		if isinstance(cell_value, str):
-			cell_value = cell_value.strip()
+	return converters
 
-		check_field_type(fld, cell_value)
 
-		if fld == 'ACCT_ACNO':
-			cell_value = str(int(cell_value))
 
-		if fld in ['SCTYID_SMSEQ', 'SCTYID_SEDOL', 'SCTYID_CUSIP'] and isinstance(cell_value, float):
-			cell_value = str(int(cell_value))
-		
-		if fld in ['TRDDATE', 'STLDATE', 'ENTRDATE']:
-			# some FT files uses traditional excel date, some uses
-			# a float number to represent date.
-			if is_htm_portfolio(trade_info['ACCT_ACNO']):
-				cell_value = xldate_as_datetime(cell_value, get_datemode())
-			else:
-				cell_value = convert_float_to_datetime(cell_value)
-
-		# if fld in ['QTY', 'ACCRBAS', 'TRADEPRC']:
-		# 	logger.debug('read_line(): read field {0}'.format(fld))
-		# 	cell_value = read_value_as_float(cell_value)
-
-		trade_info[fld] = cell_value
-		column = column + 1
+def convert_account_number(cell_value):
+	return str(int(cell_value))
+
 
-		try:
-			if not trade_info['TRANTYP'] in ['Purch', 'Sale']:
-				trade_info = None
-				break
-		except KeyError:
-			pass
-	# end of for loop
+
+def read_line(ws, row, fields, converters=None):
+	"""
+	Read the trade information from a line. If the transaction is not
+	a purchase or sale, return None.
+
+	converters: the column converters from get_converters(fields), if not
+	given, they are created from the fields.
+
+	The trade information is a row of get_row_type(fields), with every
+	column of the line.
+	"""
+	trace('read_line(): row=%s', row)
+
+	if converters is None:
+		converters = get_converters(fields)
+
+	values = read_row_values(ws, row, len(fields))
+	trade_info = get_row_type(fields)(*[convert(cell_value) for convert, cell_value \
+											in zip(converters, values)])
+
+	# rows are usually filtered by TRANTYP before, see get_row_filter()
+	if 'TRANTYP' in trade_info and not is_purchase_sale(trade_info['TRANTYP']):
+		return None
+
+	date_fields = [fld for fld in ['TRDDATE', 'STLDATE', 'ENTRDATE'] if fld in trade_info]
+	if len(date_fields) > 0:
+		convert_date = get_date_converter(trade_info['ACCT_ACNO'])
+		for fld in date_fields:
+			trade_info[fld] = convert_date(trade_info[fld])
 
 	return trade_info
 
 
 
+def is_purchase_sale(transaction_type):
+	if transaction_type in ['Purch', 'Sale']:
+		return True
+	else:
+		return False
+
+
+
+def get_date_converter(portfolio_id):
+	"""
+	Some FT files uses traditional excel date, some uses a float number
+	to represent date.
+	"""
+	if is_htm_portfolio(portfolio_id):
+		return convert_excel_date
+	else:
+		return convert_float_to_datetime
+
+
+
+def convert_excel_date(value):
+	return get_cached_date(value, excel_date_to_datetime)
+
+
+
 def is_htm_portfolio(portfolio_id):
 	# htm_portfolio = ['12229', '12366', '12528', '12548', '12630', '12732', '12733']
 	# if portfolio_id in htm_portfolio:
@@ -168,25 +393,26 @@ def is_htm_portfolio(portfolio_id):
 	# else:
 	# 	return False
 
-	if get_portfolio_accounting_treatment(portfolio_id) == 'HTM':
+	if get_accounting_treatment(portfolio_id) == 'HTM':
 		return True
 	else:
 		return False
 
 
 
-def check_field_type(fld, cell_value):
-	if fld in ['TRANTYP', 'TRANCOD', 'LCLCCY', 'SCTYID_ISIN'] \
-		and not isinstance(cell_value, str):
-		logger.error('check_field_type(): field {0} should be string, value={1}'.
-						format(fld, cell_value))
-		raise InvalidFieldValue()
+def get_field_types():
+	"""
+	The type of cell value expected for a field, before conversion.
+	"""
+	field_types = {}
+	for fld in ['TRANTYP', 'TRANCOD', 'LCLCCY', 'SCTYID_ISIN']:
+		field_types[fld] = str
 
-	if fld in ['ACCT_ACNO', 'TRDDATE', 'STLDATE', 'ENTRDATE', 'GROSSBAS', 
-				'PRINB', 'GROSSLCL', 'FXRATE'] and not isinstance(cell_value, float):
-		logger.error('check_field_type(): field {0} should be float, value={1}'.
-							format(fld, cell_value))
-		raise InvalidFieldValue()
+	for fld in ['ACCT_ACNO', 'TRDDATE', 'STLDATE', 'ENTRDATE', 'GROSSBAS', 
+				'PRINB', 'GROSSLCL', 'FXRATE']:
+		field_types[fld] = float
+
+	return field_types
 
 
 
@@ -194,16 +420,13 @@ def convert_float_to_datetime(value):
 	"""
 	the value is of type float, in the form of 'mmddyyyy' or 'mddyyyy'
 	"""
-	month = int(value/1000000)
-	day = int((value - month*1000000)/10000)
-	year = int(value - month*1000000 - day*10000)
-	return datetime(year, month, day)
+	return get_cached_date(value, mmddyyyy_to_datetime)
 
 
 
 def validate_trade_info(trade_info):
-	logger.debug('validate_trade_info(): trade date={0}, isin={1}, gross amount={2}'.
-					format(trade_info['TRDDATE'], trade_info['SCTYID_ISIN'], trade_info['GROSSBAS']))
+	trace('validate_trade_info(): trade date=%s, isin=%s, gross amount=%s',
+			trade_info['TRDDATE'], trade_info['SCTYID_ISIN'], trade_info['GROSSBAS'])
 
 	if trade_info['STLDATE'] < trade_info['TRDDATE'] or \
 		trade_info['ENTRDATE'] < trade_info['TRDDATE']:
@@ -267,6 +490,8 @@ def validate_trade_info(trade_info):
 
 
 def convert_to_geneva_records(output):
+	check_investment_ids(output)
+
 	records = []
 	record_fields = get_record_fields()
 	for trade_info in output:
@@ -277,6 +502,11 @@ def convert_to_geneva_records(output):
 
 
 def get_LocationAccount(portfolio_id):
+	return get_portfolio_info('LocationAccount', portfolio_id, find_LocationAccount)
+
+
+
+def find_LocationAccount(portfolio_id):
 	boc_portfolios = ['12229', '12366', '12528', '12630', '12732', '12733']
 	jpm_portfolios = ['12548']
 
@@ -292,6 +522,11 @@ def get_LocationAccount(portfolio_id):
 
 
 def get_portfolio_currency(portfolio_id):
+	return get_portfolio_info('PortfolioCurrency', portfolio_id, find_portfolio_currency)
+
+
+
+def find_portfolio_currency(portfolio_id):
 	# A portfolio's base currency
 	usd_portfolio = ['21815']
 	hkd_portfolio = ['12229', '12366', '12528', '12548', '12630', '12732', '12733']
@@ -308,6 +543,11 @@ def get_portfolio_currency(portfolio_id):
 
 
 def get_FT_portfolio_currency(portfolio_id):
+	return get_portfolio_info('FTPortfolioCurrency', portfolio_id, find_FT_portfolio_currency)
+
+
+
+def find_FT_portfolio_currency(portfolio_id):
 	# FT portfolio's base currency setting. It is not always consistent with
 	# the correct setting.
 	FT_usd_portfolio = ['21815']
@@ -333,59 +573,52 @@ def get_CounterTDateFx(portfolio_id, FT_fx):
 
 
 
-def create_record(trade_info, record_fields):
-
-	known_fields = {
-		'RecordAction':'InsertUpdate',
-		'KeyValue.KeyName':'UserTranId1',
-		'Strategy':'Default',
-		'Broker':'journaling entries',
-		'PriceDenomination':'CALC',
-		'NetInvestmentAmount':'CALC',
-		'NetCounterAmount':'CALC',
-		'TradeFX':'',
-		'NotionalAmount':'CALC',
-		'FundStructure':'CALC',
-		'AccruedInterest':'CALC',
-		'InvestmentAccruedInterest':'CALC'
-	}
-	
-	trade_type = {'Purch':'Buy', 'Sale':'Sell'}
-
-	new_record = {}
-	for record_field in record_fields:
-
-		if record_field in known_fields:
-			new_record[record_field] = known_fields[record_field]
-
-		if record_field == 'RecordType':
-			new_record[record_field] = trade_type[trade_info['TRANTYP']]
-		elif record_field == 'Portfolio':
-			new_record[record_field] = trade_info['ACCT_ACNO']
-		elif record_field == 'LocationAccount':
-			new_record[record_field] = get_LocationAccount(trade_info['ACCT_ACNO'])
-		elif record_field == 'Investment':
-			new_record[record_field] = get_geneva_investment_id(trade_info)
-		elif record_field == 'EventDate':
-			new_record[record_field] = convert_datetime_to_string(trade_info['TRDDATE'])
-		elif record_field == 'SettleDate':
-			new_record[record_field] = convert_datetime_to_string(trade_info['STLDATE'])
-		elif record_field == 'ActualSettleDate':
-			new_record[record_field] = new_record['SettleDate']
-		elif record_field == 'Quantity':
-			new_record[record_field] = trade_info['QTY']
-		elif record_field == 'Price':
-			new_record[record_field] = trade_info['TRADEPRC']
-		elif record_field == 'CounterInvestment':
-			new_record[record_field] = trade_info['LCLCCY']
-		elif record_field == 'CounterFXDenomination':
-			new_record[record_field] = get_portfolio_currency(trade_info['ACCT_ACNO'])
-		elif record_field == 'CounterTDateFx':
-			new_record[record_field] = get_CounterTDateFx(trade_info['ACCT_ACNO'], trade_info['FXRATE'])
-		elif record_field == 'trade_expenses':
-			new_record[record_field] = get_trade_expenses(trade_info)
-	# end of for loop
+# The Geneva record of a trade is built from the constant fields and the
+# field extractors below, see create_record().
+record_known_fields = {
+	'RecordAction':'InsertUpdate',
+	'KeyValue.KeyName':'UserTranId1',
+	'Strategy':'Default',
+	'Broker':'journaling entries',
+	'PriceDenomination':'CALC',
+	'NetInvestmentAmount':'CALC',
+	'NetCounterAmount':'CALC',
+	'TradeFX':'',
+	'NotionalAmount':'CALC',
+	'FundStructure':'CALC',
+	'AccruedInterest':'CALC',
+	'InvestmentAccruedInterest':'CALC'
+}
+
+record_trade_type = {'Purch':'Buy', 'Sale':'Sell'}
+
+record_extractors = {
+	'RecordType':lambda trade_info, record: record_trade_type[trade_info['TRANTYP']],
+	'Portfolio':lambda trade_info, record: trade_info['ACCT_ACNO'],
+	'LocationAccount':lambda trade_info, record: get_LocationAccount(trade_info['ACCT_ACNO']),
+	'Investment':lambda trade_info, record: get_geneva_investment_id(trade_info),
+	'EventDate':lambda trade_info, record: convert_datetime_to_string(trade_info['TRDDATE']),
+	'SettleDate':lambda trade_info, record: convert_datetime_to_string(trade_info['STLDATE']),
+	'ActualSettleDate':lambda trade_info, record: record.SettleDate,
+	'Quantity':lambda trade_info, record: trade_info['QTY'],
+	'Price':lambda trade_info, record: trade_info['TRADEPRC'],
+	'CounterInvestment':lambda trade_info, record: trade_info['LCLCCY'],
+	'CounterFXDenomination':lambda trade_info, record: get_portfolio_currency(trade_info['ACCT_ACNO']),
+	'CounterTDateFx':lambda trade_info, record: get_CounterTDateFx(trade_info['ACCT_ACNO'], trade_info['FXRATE']),
+	'trade_expenses':lambda trade_info, record: get_trade_expenses(trade_info)
+}
+
+build_record = compile_record_builder(record_known_fields, record_extractors)
+
+
+
+def create_record(trade_info, record_fields=None):
+	"""
+	Create the Geneva record of the trade.
 
+	record_fields: not used, the record fields are always get_record_fields().
+	"""
+	new_record = build_record(trade_info)
 	create_record_key_value(new_record, trade_info['PRINB'])
 
 	return new_record
@@ -403,19 +636,61 @@ def get_geneva_investment_id(trade_info):
 		logger.error('get_geneva_investment_id(): not a HTM portfolio')
 		raise InvestmentIdNotFound()
 
+	id_type, security_id = get_security_id(trade_info)
+	investment_id = get_investment_id(trade_info['ACCT_ACNO'], id_type, security_id)
+	if investment_id is None:
+		logger.error('get_geneva_investment_id(): no investment id found for {0} {1}'.
+						format(id_type, security_id))
+		raise InvestmentIdNotFound()
+
+	return investment_id
+
+
+
+def get_security_id(trade_info):
+	"""
+	Return the security identifier of a trade as (id_type, security_id),
+	in the order of ISIN, SEDOL and CUSIP.
+	"""
 	if trade_info['SCTYID_ISIN'] != '':
-		return get_investment_Ids(trade_info['ACCT_ACNO'], 'ISIN', trade_info['SCTYID_ISIN'])[0]
+		return ('ISIN', trade_info['SCTYID_ISIN'])
 	elif trade_info['SCTYID_SEDOL'] != '':
-		return get_investment_Ids(trade_info['ACCT_ACNO'], 'SEDOL', trade_info['SCTYID_SEDOL'])[0]
+		return ('SEDOL', trade_info['SCTYID_SEDOL'])
 	elif trade_info['SCTYID_CUSIP'] != '':
-		return get_investment_Ids(trade_info['ACCT_ACNO'], 'CUSIP', trade_info['SCTYID_CUSIP'])[0]
+		return ('CUSIP', trade_info['SCTYID_CUSIP'])
 	else:
-		logger.error('get_geneva_investment_id(): no security identifier found for SCTYID_SMSEQ:{0}'.
+		logger.error('get_security_id(): no security identifier found for SCTYID_SMSEQ:{0}'.
 						format(trade_info['SCTYID_SMSEQ']))
 		raise InvestmentIdNotFound()
 
 
 
+def check_investment_ids(output):
+	"""
+	Resolve the Geneva investment ids for all trades in one pass, before
+	the records are created, so that each security is looked up only once.
+
+	If some securities cannot be found, all of them are printed and logged,
+	then it throws an error.
+	"""
+	keys = []
+	for trade_info in output:
+		if is_htm_portfolio(trade_info['ACCT_ACNO']):
+			id_type, security_id = get_security_id(trade_info)
+			keys.append((trade_info['ACCT_ACNO'], id_type, security_id))
+
+	unresolved = resolve_investment_ids(keys)
+	if len(unresolved) > 0:
+		for (portfolio_id, id_type, security_id) in unresolved:
+			print('investment id not found: portfolio {0}, {1} {2}'.
+					format(portfolio_id, id_type, security_id))
+
+		logger.error('check_investment_ids(): {0} securities not found'.
+						format(len(unresolved)))
+		raise InvestmentIdNotFound()
+
+
+
 def get_trade_expenses(trade_info):
 	"""
 	Extract trade related expenses and group them into 5 categories:
@@ -449,13 +724,15 @@ def create_record_key_value(record, net_amount):
 	In this case the key value will be a string of the following format:
 
 	<portfolio_code>_<trade_date>_<Buy or Sell>_<hash value of (isin, net_settlement, broker)>
+
+	record: a Geneva record from build_record(), its fields are attributes.
 	"""
-	record['KeyValue'] = record['Portfolio']+ '_' + record['EventDate'] + '_' \
-							+ record['RecordType'] + '_' \
-							+ convert_investment_id(record['Investment']) \
+	record.KeyValue = record.Portfolio+ '_' + record.EventDate + '_' \
+							+ record.RecordType + '_' \
+							+ convert_investment_id(record.Investment) \
 							+ str(int(abs(net_amount*10000)))
 
-	record['UserTranId1'] = record['KeyValue']
+	record.UserTranId1 = record.KeyValue
 
 
 
@@ -488,17 +765,31 @@ def create_geneva_flat_file(output):
 	\\clfhkgvapp01\FlatFile
 	"""
 	isin_list = []
+	isin_set = set()
 	for trade_info in output:
-		if trade_info['SCTYID_ISIN'] in isin_list:
-			continue
-		elif trade_info['SCTYID_ISIN'].strip() == '':
-			print('empty isin code!!')
-			import sys
-			sys.exit()
-		else:
-			isin_list.append(trade_info['SCTYID_ISIN'])
+		add_isin(trade_info, isin_list, isin_set)
+
+	write_flat_file(isin_list)
 
 
+
+def add_isin(trade_info, isin_list, isin_set):
+	"""
+	Add the ISIN code of the trade to the list, if it is not there yet.
+	"""
+	if trade_info['SCTYID_ISIN'] in isin_set:
+		return
+	elif trade_info['SCTYID_ISIN'].strip() == '':
+		print('empty isin code!!')
+		import sys
+		sys.exit()
+	else:
+		isin_list.append(trade_info['SCTYID_ISIN'])
+		isin_set.add(trade_info['SCTYID_ISIN'])
+
+
+
+def write_flat_file(isin_list):
 	with open(get_input_directory()+'\\bondmaster.csv', 'w', newline='') as csvfile:
 		file_writer = csv.writer(csvfile)
 		
@@ -507,7 +798,6 @@ def create_geneva_flat_file(output):
 
 
 
-
 def create_12528_trade_after_20160831():
 	"""
 	As of 20160930, the 12528 portfolio has been sold out. After that,
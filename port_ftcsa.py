@@ -13,16 +13,31 @@
 # Note that we do the above lookup for the list of unmatched positions, i.e.,
 # positions that have the above transactions.
 #
-from trade_converter.utility import logger, get_datemode, get_record_fields, \
-									get_current_path, convert_datetime_to_string, \
-									is_blank_line, is_empty_cell, get_input_directory
+from trade_converter.utility import logger, trace, dump_trace, \
+									get_record_fields, get_current_path, \
+									convert_datetime_to_string, \
+									is_blank_line, is_empty_cell, get_input_directory, \
+									read_row_values, get_column_converters, \
+									float_to_string, combine_converters, \
+									get_type_checker, get_row_filter, map_files
 from trade_converter.port_12307 import fix_duplicate_key_value
 from trade_converter.tc import write_csv
-from xlrd import open_workbook
-from xlrd.xldate import xldate_as_datetime
+from trade_converter.workbook_reader import open_worksheet, close_worksheet
+from trade_converter.record_types import get_row_type, compile_record_builder
 from datetime import datetime
-from investment_lookup.id_lookup import get_investment_Ids, \
-										get_portfolio_accounting_treatment
+from bisect import bisect_right
+from trade_converter.portfolio_cache import get_portfolio_info, \
+										get_accounting_treatment
+# the same lookup functions as port_ft, as the portfolio cache is shared
+from trade_converter.port_ft import find_LocationAccount, find_portfolio_currency, \
+										find_FT_portfolio_currency, \
+										LocationAccountNotFound, PortfolioCurrencyNotFound
+# the same security ids as port_ft, and so the same exception when not found
+from trade_converter.port_ft import get_security_id, check_investment_ids, \
+										InvestmentIdNotFound
+# dates and account numbers are in the same format as in FT trade files
+from trade_converter.port_ft import get_date_converter, convert_account_number
+from trade_converter.investment_resolver import get_investment_id
 import csv, argparse, os
 
 
@@ -33,15 +48,6 @@ class InvalidFieldValue(Exception):
 class InvalidTradeInfo(Exception):
 	pass
 
-class LocationAccountNotFound(Exception):
-	pass
-
-class PortfolioCurrencyNotFound(Exception):
-	pass
-
-class InvestmentIdNotFound(Exception):
-	pass
-
 class TradeExpenseNotHandled(Exception):
 	pass
 
@@ -92,8 +98,7 @@ def read_match_status(match_file):
 
 	difference = geneva position - bank position
 	"""
-	wb = open_workbook(filename=match_file)
-	ws = wb.sheet_by_index(0)
+	ws = open_worksheet(match_file)
 
 	fields = read_data_fields(ws, 0)
 	row = 1
@@ -111,6 +116,7 @@ def read_match_status(match_file):
 
 		row = row + 1
 
+	close_worksheet(ws)
 	return output
 
 
@@ -162,30 +168,51 @@ def read_match_line(ws, row, fields):
 
 
 
-def read_transaction_file(trade_file, isin_list, output):
+def read_transaction_file(trade_file, isin_list, output, predicates=None):
 	"""
 	Note: Read the transaction file from FT, for securities in isin_list only.
+
+	The transaction type and ISIN code of a row are checked before the rest
+	of the row is read, so rows not needed are skipped.
+
+	predicates: optional, more row filters in addition to the above, see
+	port_ft.read_transaction_file().
 	"""
 	logger.debug('read_transaction_file(): {0}'.format(trade_file))
 
-	wb = open_workbook(filename=trade_file)
-	ws = wb.sheet_by_index(0)
+	ws = open_worksheet(trade_file)
 
 	fields = read_data_fields(ws, 0)
+	converters = get_converters(fields)
+
+	isin_set = set(isin_list)
+	row_predicates = {
+		'TRANTYP':is_transfer_or_redemption,
+		'SCTYID_ISIN':lambda isin: isin in isin_set
+	}
+	if not predicates is None:
+		row_predicates.update(predicates)
+	keep_row = get_row_filter(fields, converters, row_predicates)
 	
 	row = 1
 	while row < ws.nrows:
 		if is_blank_line(ws, row):
 			break
 
-		trade_info = read_line(ws, row, fields)
-		if not trade_info is None and trade_info['SCTYID_ISIN'] in isin_list:
+		if not keep_row(ws, row):
+			row = row + 1
+			continue
+
+		trade_info = read_line(ws, row, fields, converters)
+		if not trade_info is None and trade_info['SCTYID_ISIN'] in isin_set:
 			# validate_trade_info(trade_info)
 			output.append(trade_info)
 
 		row = row + 1
 	# end of while loop
 
+	close_worksheet(ws)
+
 
 
 def read_data_fields(ws, row):
@@ -203,7 +230,46 @@ def read_data_fields(ws, row):
 
 
 
-def read_line(ws, row, fields):
+def get_converters(fields):
+	"""
+	Create the column converters for a transaction file, based on its data
+	fields. Each converter converts the cell value first, then checks the
+	type of the result (see get_field_types()).
+
+	Date fields are not converted here, because how to convert them depends
+	on the portfolio, see get_date_converter().
+	"""
+	converter_map = {
+		'ACCT_ACNO':convert_account_number,
+		'SCTYID_SMSEQ':float_to_string,
+		'SCTYID_SEDOL':float_to_string,
+		'SCTYID_CUSIP':float_to_string
+	}
+
+	for fld in ['QTY', 'GROSSBAS', 'PRINB', 'RGLBVBAS', 'RGLCCYCLS', \
+				'ACCRBAS', 'TRNBVBAS', 'GROSSLCL', 'FXRATE', 'TRADEPRC']:
+		converter_map[fld] = convert_blank_to_zero
+
+	converters = get_column_converters(fields, converter_map)
+	field_types = get_field_types()
+	for column, fld in enumerate(fields):
+		if fld in field_types and not field_types[fld] is datetime:
+			check = get_type_checker(fld, field_types[fld], InvalidFieldValue)
+			converters[column] = combine_converters(converters[column], check)
+
+	return converters
+
+
+
+def convert_blank_to_zero(cell_value):
+	if isinstance(cell_value, str) and cell_value == '':
+		return 0.0
+
+	return cell_value
+
+
+
+def read_line(ws, row, fields, converters=None):
 	"""
 	Read a line, store as trade information. Note, it only read lines whose
 	transaction type is one of the following:
@@ -216,51 +282,41 @@ def read_line(ws, row, fields):
 	6. TNDRL: buy back by issuer
 
 	If not, then it returns None.
+
+	converters: the column converters from get_converters(fields), if not
+	given, they are created from the fields.
+
+	The trade information is a row of get_row_type(fields), with every
+	column of the line.
 	"""
-	trade_info = {}
-	column = 0
+	trace('read_line(): row=%s', row)
 
-	for fld in fields:
-		logger.debug('read_line(): row={0}, column={1}'.format(row, column))
+	if converters is None:
+		converters = get_converters(fields)
 
-		cell_value = ws.cell_value(row, column)
-		if isinstance(cell_value, str):
-			cell_value = cell_value.strip()
+	values = read_row_values(ws, row, len(fields))
+	trade_info = get_row_type(fields)(*[convert(cell_value) for convert, cell_value \
+											in zip(converters, values)])
 
-		if fld == 'ACCT_ACNO':
-			cell_value = str(int(cell_value))
+	# rows are usually filtered by TRANTYP before, see get_row_filter()
+	if 'TRANTYP' in trade_info and not is_transfer_or_redemption(trade_info['TRANTYP']):
+		return None
 
-		if fld in ['SCTYID_SMSEQ', 'SCTYID_SEDOL', 'SCTYID_CUSIP'] and isinstance(cell_value, float):
-			cell_value = str(int(cell_value))
-		
-		if fld in ['TRDDATE', 'STLDATE', 'ENTRDATE']:
-			# some FT files uses traditional excel date, some uses
-			# a float number to represent date.
-			if is_htm_portfolio(trade_info['ACCT_ACNO']):
-				cell_value = xldate_as_datetime(cell_value, get_datemode())
-			else:
-				cell_value = convert_float_to_datetime(cell_value)
+	date_fields = [fld for fld in ['TRDDATE', 'STLDATE', 'ENTRDATE'] if fld in trade_info]
+	if len(date_fields) > 0:
+		convert_date = get_date_converter(trade_info['ACCT_ACNO'])
+		for fld in date_fields:
+			trade_info[fld] = date_checkers[fld](convert_date(trade_info[fld]))
 
-		if fld in ['QTY', 'GROSSBAS', 'PRINB', 'RGLBVBAS', 'RGLCCYCLS', \
-					'ACCRBAS', 'TRNBVBAS', 'GROSSLCL', 'FXRATE', 'TRADEPRC'] \
-					and isinstance(cell_value, str) and cell_value.strip() == '':	
-			cell_value = 0.0
-		
+	return trade_info
 
-		check_field_type(fld, cell_value)
-		trade_info[fld] = cell_value
-		column = column + 1
 
-		try:
-			if not trade_info['TRANTYP'] in ['IATSW', 'IATSA', 'CSA', 'CSW', \
-				'CALLED', 'TNDRL']:
-				trade_info = None
-				break
-		except KeyError:
-			pass
-	# end of for loop
 
-	return trade_info
+def is_transfer_or_redemption(transaction_type):
+	if transaction_type in ['IATSW', 'IATSA', 'CSA', 'CSW', 'CALLED', 'TNDRL']:
+		return True
+	else:
+		return False
 
 
 
@@ -271,48 +327,43 @@ def is_htm_portfolio(portfolio_id):
 	# else:
 	# 	return False
 
-	if get_portfolio_accounting_treatment(portfolio_id) == 'HTM':
+	if get_accounting_treatment(portfolio_id) == 'HTM':
 		return True
 	else:
 		return False
 
 
 
-def check_field_type(fld, cell_value):
-	if fld in ['ACCT_ACNO', 'TRANTYP', 'TRANCOD', 'LCLCCY', 'SCTYID_ISIN'] \
-		and not isinstance(cell_value, str):
-		logger.error('check_field_type(): field {0} should be string, value={1}'.
-						format(fld, cell_value))
-		raise InvalidFieldValue()
+def get_field_types():
+	"""
+	The type of cell value expected for a field, after conversion.
+	"""
+	field_types = {}
+	for fld in ['ACCT_ACNO', 'TRANTYP', 'TRANCOD', 'LCLCCY', 'SCTYID_ISIN']:
+		field_types[fld] = str
 
-	if fld in ['QTY', 'GROSSBAS', 'PRINB', 'RGLBVBAS', 'RGLCCYCLS', 'ACCRBAS', \
-				'TRNBVBAS', 'GROSSLCL', 'FXRATE', 'TRADEPRC'] \
-				and not isinstance(cell_value, float):		
-		logger.error('check_field_type(): field {0} should be float, value={1}'.
-							format(fld, cell_value))
-		raise InvalidFieldValue()
+	for fld in ['QTY', 'GROSSBAS', 'PRINB', 'RGLBVBAS', 'RGLCCYCLS', 'ACCRBAS', \
+				'TRNBVBAS', 'GROSSLCL', 'FXRATE', 'TRADEPRC']:
+		field_types[fld] = float
 
-	if fld in ['TRDDATE', 'STLDATE', 'ENTRDATE'] and not isinstance(cell_value, datetime):
-		logger.error('check_field_type(): field {0} should be datetime, value={1}'.
-							format(fld, cell_value))
-		raise InvalidFieldValue()
+	for fld in ['TRDDATE', 'STLDATE', 'ENTRDATE']:
+		field_types[fld] = datetime
 
+	return field_types
 
 
-def convert_float_to_datetime(value):
-	"""
-	the value is of type float, in the form of 'mmddyyyy' or 'mddyyyy'
-	"""
-	month = int(value/1000000)
-	day = int((value - month*1000000)/10000)
-	year = int(value - month*1000000 - day*10000)
-	return datetime(year, month, day)
+
+# type checkers of the date fields, built once, they are called after the
+# dates are converted in read_line().
+date_checkers = {}
+for fld in ['TRDDATE', 'STLDATE', 'ENTRDATE']:
+	date_checkers[fld] = get_type_checker(fld, datetime, InvalidFieldValue)
 
 
 
 def validate_trade_info(trade_info):
-	logger.debug('validate_trade_info(): trade date={0}, isin={1}, gross amount={2}'.
-					format(trade_info['TRDDATE'], trade_info['SCTYID_ISIN'], trade_info['GROSSBAS']))
+	trace('validate_trade_info(): trade date=%s, isin=%s, gross amount=%s',
+			trade_info['TRDDATE'], trade_info['SCTYID_ISIN'], trade_info['GROSSBAS'])
 
 	if trade_info['STLDATE'] < trade_info['TRDDATE'] or \
 		trade_info['ENTRDATE'] < trade_info['TRDDATE']:
@@ -341,6 +392,8 @@ def validate_trade_info(trade_info):
 
 
 def convert_to_geneva_records(output):
+	check_investment_ids(output)
+
 	records = []
 	record_fields = get_record_fields()
 	for trade_info in output:
@@ -351,51 +404,17 @@ def convert_to_geneva_records(output):
 
 
 def get_LocationAccount(portfolio_id):
-	boc_portfolios = ['12229', '12366', '12528', '12630', '12732', '12733']
-	jpm_portfolios = ['12548']
-
-	if portfolio_id in boc_portfolios:
-		return 'BOCHK'
-	elif portfolio_id in jpm_portfolios:
-		return 'JPM'
-	else:
-		logger.error('get_LocationAccount(): no LocationAccount found for portfolio id {0}'.
-						format(portfolio_id))
-		raise LocationAccountNotFound()
+	return get_portfolio_info('LocationAccount', portfolio_id, find_LocationAccount)
 
 
 
 def get_portfolio_currency(portfolio_id):
-	# A portfolio's base currency
-	usd_portfolio = ['21815']
-	hkd_portfolio = ['12229', '12366', '12528', '12548', '12630', '12732', '12733']
-
-	if portfolio_id in usd_portfolio:
-		return 'USD'
-	elif portfolio_id in hkd_portfolio:
-		return 'HKD'
-	else:
-		logger.error('get_portfolio_currency(): no portfolio currency found for {0}'.
-						format(portfolio_id))
-		raise PortfolioCurrencyNotFound()
+	return get_portfolio_info('PortfolioCurrency', portfolio_id, find_portfolio_currency)
 
 
 
 def get_FT_portfolio_currency(portfolio_id):
-	# FT portfolio's base currency setting. It is not always consistent with
-	# the correct setting.
-	FT_usd_portfolio = ['21815']
-	FT_hkd_portfolio = ['12229', '12366', '12528', '12548', '12630', '12732', \
-						'12733', '12307', '19437']
-
-	if portfolio_id in FT_usd_portfolio:
-		return 'USD'
-	elif portfolio_id in FT_hkd_portfolio:
-		return 'HKD'
-	else:
-		logger.error('get_FT_portfolio_currency(): no portfolio currency found for {0}'.
-						format(portfolio_id))
-		raise PortfolioCurrencyNotFound()
+	return get_portfolio_info('FTPortfolioCurrency', portfolio_id, find_FT_portfolio_currency)
 
 
 
@@ -407,65 +426,59 @@ def get_CounterTDateFx(portfolio_id, FT_fx):
 
 
 
-def create_record(trade_info, record_fields):
+# The Geneva record of a trade is built from the constant fields and the
+# field extractors below, see create_record().
+record_known_fields = {
+	'RecordAction':'InsertUpdate',
+	'KeyValue.KeyName':'UserTranId1',
+	'Strategy':'Default',
+	'Broker':'journaling entries',
+	'PriceDenomination':'CALC',
+	'NetInvestmentAmount':'CALC',
+	'NetCounterAmount':'CALC',
+	'TradeFX':'',
+	'NotionalAmount':'CALC',
+	'FundStructure':'CALC',
+	'AccruedInterest':'CALC',
+	'InvestmentAccruedInterest':'CALC'
+}
+
+record_trade_type = {'Purch':'Buy',
+						'Sale':'Sell',
+						'CSA':'Buy',
+						'CSW':'Sell',
+						'IATSA':'Buy',
+						'IATSW':'Sell',
+						'CALLED':'Sell',
+						'TNDRL':'Sell'}
+
+record_extractors = {
+	'RecordType':lambda trade_info, record: record_trade_type[trade_info['TRANTYP']],
+	'Portfolio':lambda trade_info, record: trade_info['ACCT_ACNO'],
+	'LocationAccount':lambda trade_info, record: get_LocationAccount(trade_info['ACCT_ACNO']),
+	'Investment':lambda trade_info, record: get_geneva_investment_id(trade_info),
+	'EventDate':lambda trade_info, record: convert_datetime_to_string(trade_info['TRDDATE']),
+	'SettleDate':lambda trade_info, record: convert_datetime_to_string(trade_info['STLDATE']),
+	'ActualSettleDate':lambda trade_info, record: record.SettleDate,
+	'Quantity':lambda trade_info, record: trade_info['QTY'],
+	'Price':lambda trade_info, record: get_trade_price(trade_info),
+	'CounterInvestment':lambda trade_info, record: trade_info['LCLCCY'],
+	'CounterFXDenomination':lambda trade_info, record: get_portfolio_currency(trade_info['ACCT_ACNO']),
+	'CounterTDateFx':lambda trade_info, record: get_CounterTDateFx(trade_info['ACCT_ACNO'], trade_info['FXRATE']),
+	'trade_expenses':lambda trade_info, record: get_trade_expenses(trade_info)
+}
+
+build_record = compile_record_builder(record_known_fields, record_extractors)
+
+
+
+def create_record(trade_info, record_fields=None):
+	"""
+	Create the Geneva record of the trade.
 
-	known_fields = {
-		'RecordAction':'InsertUpdate',
-		'KeyValue.KeyName':'UserTranId1',
-		'Strategy':'Default',
-		'Broker':'journaling entries',
-		'PriceDenomination':'CALC',
-		'NetInvestmentAmount':'CALC',
-		'NetCounterAmount':'CALC',
-		'TradeFX':'',
-		'NotionalAmount':'CALC',
-		'FundStructure':'CALC',
-		'AccruedInterest':'CALC',
-		'InvestmentAccruedInterest':'CALC'
-	}
-	
-	trade_type = {'Purch':'Buy',
-					'Sale':'Sell',
-					'CSA':'Buy',
-					'CSW':'Sell',
-					'IATSA':'Buy',
-					'IATSW':'Sell',
-					'CALLED':'Sell',
-					'TNDRL':'Sell'}
-
-	new_record = {}
-	for record_field in record_fields:
-
-		if record_field in known_fields:
-			new_record[record_field] = known_fields[record_field]
-
-		if record_field == 'RecordType':
-			new_record[record_field] = trade_type[trade_info['TRANTYP']]
-		elif record_field == 'Portfolio':
-			new_record[record_field] = trade_info['ACCT_ACNO']
-		elif record_field == 'LocationAccount':
-			new_record[record_field] = get_LocationAccount(trade_info['ACCT_ACNO'])
-		elif record_field == 'Investment':
-			new_record[record_field] = get_geneva_investment_id(trade_info)
-		elif record_field == 'EventDate':
-			new_record[record_field] = convert_datetime_to_string(trade_info['TRDDATE'])
-		elif record_field == 'SettleDate':
-			new_record[record_field] = convert_datetime_to_string(trade_info['STLDATE'])
-		elif record_field == 'ActualSettleDate':
-			new_record[record_field] = new_record['SettleDate']
-		elif record_field == 'Quantity':
-			new_record[record_field] = trade_info['QTY']
-		elif record_field == 'Price':
-			new_record[record_field] = get_trade_price(trade_info)
-		elif record_field == 'CounterInvestment':
-			new_record[record_field] = trade_info['LCLCCY']
-		elif record_field == 'CounterFXDenomination':
-			new_record[record_field] = get_portfolio_currency(trade_info['ACCT_ACNO'])
-		elif record_field == 'CounterTDateFx':
-			new_record[record_field] = get_CounterTDateFx(trade_info['ACCT_ACNO'], trade_info['FXRATE'])
-		elif record_field == 'trade_expenses':
-			new_record[record_field] = get_trade_expenses(trade_info)
-	# end of for loop
+	record_fields: not used, the record fields are always get_record_fields().
+	"""
+	new_record = build_record(trade_info)
 
 	if trade_info['TRANTYP'] in ['IATSW', 'CSW']:
 		net_amount = trade_info['TRNBVBAS']
@@ -488,17 +501,15 @@ def get_geneva_investment_id(trade_info):
 		logger.error('get_geneva_investment_id(): not a HTM portfolio')
 		raise InvestmentIdNotFound()
 
-	if trade_info['SCTYID_ISIN'] != '':
-		return get_investment_Ids(trade_info['ACCT_ACNO'], 'ISIN', trade_info['SCTYID_ISIN'])[0]
-	elif trade_info['SCTYID_SEDOL'] != '':
-		return get_investment_Ids(trade_info['ACCT_ACNO'], 'SEDOL', trade_info['SCTYID_SEDOL'])[0]
-	elif trade_info['SCTYID_CUSIP'] != '':
-		return get_investment_Ids(trade_info['ACCT_ACNO'], 'CUSIP', trade_info['SCTYID_CUSIP'])[0]
-	else:
-		logger.error('get_geneva_investment_id(): no security identifier found for SCTYID_SMSEQ:{0}'.
-						format(trade_info['SCTYID_SMSEQ']))
+	id_type, security_id = get_security_id(trade_info)
+	investment_id = get_investment_id(trade_info['ACCT_ACNO'], id_type, security_id)
+	if investment_id is None:
+		logger.error('get_geneva_investment_id(): no investment id found for {0} {1}'.
+						format(id_type, security_id))
 		raise InvestmentIdNotFound()
 
+	return investment_id
+
 
 
 def get_trade_price(trade_info):
@@ -556,13 +567,15 @@ def create_record_key_value(record, net_amount, prefix):
 	In this case the key value will be a string of the following format:
 
 	<portfolio_code>_<trade_date>_<prefix>_<Buy or Sell>_<hash value of (isin, net_settlement, broker)>
+
+	record: a Geneva record from build_record(), its fields are attributes.
 	"""
-	record['KeyValue'] = record['Portfolio']+ '_' + record['EventDate'] \
-							+ '_' + prefix + '_' + record['RecordType'] \
-							+ '_' + convert_investment_id(record['Investment']) \
+	record.KeyValue = record.Portfolio+ '_' + record.EventDate \
+							+ '_' + prefix + '_' + record.RecordType \
+							+ '_' + convert_investment_id(record.Investment) \
 							+ str(int(abs(net_amount*10000)))
 
-	record['UserTranId1'] = record['KeyValue']
+	record.UserTranId1 = record.KeyValue
 
 
 
@@ -614,73 +627,287 @@ def create_geneva_flat_file(output):
 
 
 
-def filter_transaction_by_isin(isin, transaction_list):
-	output = []
+def get_signed_quantity(transaction):
+	"""
+	Transfers in reduce the quantity, transfers out and redemptions increase
+	it, as the difference in the match status is geneva position - bank
+	position.
+	"""
+	if transaction['TRANTYP'] in ['CSA', 'IATSA']:
+		return -transaction['QTY']
+	elif transaction['TRANTYP'] in ['CSW', 'IATSW', 'CALLED', 'TNDRL']:
+		return transaction['QTY']
+	else:
+		print('unhandled transaction type {0}'.format(transaction['TRANTYP']))
+		return 0
+
+
+
+def get_transaction_net_quantity(transaction_list):
+	"""
+	Net the quantities of transactions by ISIN in one pass, return a
+	dictionary isin -> net quantity, see get_signed_quantity().
+	"""
+	net_quantity = {}
 	for transaction in transaction_list:
-		if transaction['SCTYID_ISIN'] == isin:
-			output.append(transaction)
+		isin = transaction['SCTYID_ISIN']
+		net_quantity[isin] = net_quantity.get(isin, 0) + get_signed_quantity(transaction)
 
-	return output
+	return net_quantity
 
 
 
-def filter_record_by_isin(isin, record_list):
+def find_matching_subset(quantities, target, max_states=100000, max_steps=200000):
 	"""
-	Note: only works for HTM portfolios.
+	Find a subset of the quantities whose sum explains as much of the target
+	as possible, i.e., the sum is between 0 and target, and is the closest
+	to target.
+
+	Return a tuple (indices, residual), indices being the sorted list of
+	positions of the quantities in the subset, residual being target - sum.
+	If nothing can be explained, indices is empty and residual is target.
+
+	The search is bounded by max_steps, the number of sums tried, and
+	max_states, the number of sums kept, so the result depends only on the
+	input, not on how fast the machine is. Once either budget is used up,
+	the best subset found so far is returned. The search goes in two steps:
+
+	1. An exact match of 1, 2 or 3 quantities, the usual case, is looked up
+		with a hash index, see find_small_subset().
+	2. Otherwise, the reachable sums are built one quantity at a time, see
+		find_closest_subset().
 	"""
-	output = []
-	for record in record_list:
-		if record['Investment'] == isin + ' HTM':
-			output.append(record)
+	quantities = [round(quantity, 6) for quantity in quantities]
+	target = round(target, 6)
+	if target == 0:
+		return [], target
 
-	return output
+	indices, steps = find_small_subset(quantities, target, max_steps)
+	if not indices is None:
+		return indices, 0
+
+	return find_closest_subset(quantities, target, max_states, max_steps - steps)
+
+
+
+def find_small_subset(quantities, target, max_steps):
+	"""
+	Find up to 3 quantities whose sum is exactly the target, fewer quantities
+	first, then the smallest positions.
+
+	Return a tuple (indices, steps), indices being the sorted list of
+	positions, or None if not found within max_steps, steps being the
+	number of steps used.
+	"""
+	positions = {}	# quantity -> list of positions, in ascending order
+	for i, quantity in enumerate(quantities):
+		positions.setdefault(quantity, []).append(i)
+
+	def find_after(value, start):
+		# the first position of value after start, or None
+		found = positions.get(round(value, 6), [])
+		n = bisect_right(found, start)
+		if n < len(found):
+			return found[n]
+
+	if target in positions:
+		return [positions[target][0]], 0
+
+	steps = 0
+	for i, quantity in enumerate(quantities):
+		if steps >= max_steps:
+			return None, steps
+
+		steps = steps + 1
+		j = find_after(target - quantity, i)
+		if not j is None:
+			return [i, j], steps
+
+	for i in range(len(quantities)):
+		for j in range(i+1, len(quantities)):
+			if steps >= max_steps:
+				return None, steps
+
+			steps = steps + 1
+			k = find_after(target - quantities[i] - quantities[j], j)
+			if not k is None:
+				return [i, j, k], steps
+
+	return None, steps
+
+
+
+def find_closest_subset(quantities, target, max_states, max_steps):
+	"""
+	Find the subset whose sum is closest to target, without going beyond
+	it, see find_matching_subset().
+
+	Each reachable sum keeps the last quantity added and the sum before it,
+	so that the subset can be traced back. Quantities of the same sign as
+	the target are added first, larger ones first, so that the budget is
+	not used up by small sums. A sum is dropped once the quantities left
+	cannot bring it back between 0 and target.
+	"""
+	low, high = min(0, target), max(0, target)
+	same_sign = lambda i: (quantities[i] > 0) == (target > 0)
+	order = sorted((i for i, quantity in enumerate(quantities) if quantity != 0),
+					key=lambda i: (not same_sign(i), -abs(quantities[i]), i))
+
+	# the sum of positive (negative) quantities from position n in the order
+	positive_left = [0]*(len(order)+1)
+	negative_left = [0]*(len(order)+1)
+	for n in range(len(order)-1, -1, -1):
+		quantity = quantities[order[n]]
+		positive_left[n] = positive_left[n+1] + max(quantity, 0)
+		negative_left[n] = negative_left[n+1] + min(quantity, 0)
+
+	# rounded sum -> (sum before, index of the quantity added)
+	sums = {0: None}
+	live = [0]		# sums that can still be brought between 0 and target
+	best = 0
+	steps = 0
+	for n, i in enumerate(order):
+		if best == target or steps >= max_steps or len(sums) >= max_states:
+			break
+
+		quantity = quantities[i]
+		for total in list(live):
+			if steps >= max_steps or len(sums) >= max_states:
+				break
+
+			steps = steps + 1
+			new_total = round(total + quantity, 6)
+			if new_total in sums or new_total + negative_left[n+1] > high \
+				or new_total + positive_left[n+1] < low:
+				continue
+
+			sums[new_total] = (total, i)
+			live.append(new_total)
+			if low <= new_total <= high and abs(target - new_total) < abs(target - best):
+				best = new_total
+
+		live = [total for total in live if total + negative_left[n+1] <= high \
+					and total + positive_left[n+1] >= low]
+
+	indices = []
+	total = best
+	while not sums[total] is None:
+		total, i = sums[total]
+		indices.append(i)
+
+	return sorted(indices), round(target - best, 6)
+
+
+
+def get_record_net_quantity(records):
+	"""
+	Net the quantities of records by investment in one pass, return a
+	dictionary investment id -> net quantity, the same way as
+	get_transaction_net_quantity().
+	"""
+	net_quantity = {}
+	for record in records:
+		if record['RecordType'] == 'Buy':
+			quantity = -record['Quantity']
+		elif record['RecordType'] == 'Sell':
+			quantity = record['Quantity']
+		else:
+			print('unhandled record type {0}'.format(record['RecordType']))
+			quantity = 0
+
+		investment = record['Investment']
+		net_quantity[investment] = net_quantity.get(investment, 0) + quantity
+
+	return net_quantity
 
 
 
 def filter_matched_transaction(transaction_list, match_status):
 	"""
 	Return the set of transactions that can explain the difference in the
-	match status.
+	match status, and the set of ISIN codes whose difference cannot be
+	fully explained by all their transactions.
+
+	For such an ISIN, if a subset of its transactions explains part of the
+	difference (see find_matching_subset()), those transactions are kept
+	and the residual is printed, to be fixed by hand.
 	"""
-	bad_isin_list = []
+	net_quantity = get_transaction_net_quantity(transaction_list)
+	bad_isin_list = set()
 	for entry in match_status:
-		quantity = 0
-		for transaction in filter_transaction_by_isin(entry[2], transaction_list):
-			if transaction['TRANTYP'] in ['CSA', 'IATSA']:
-				quantity = quantity - transaction['QTY']
-			elif transaction['TRANTYP'] in ['CSW', 'IATSW', 'CALLED', 'TNDRL']:
-				quantity = quantity + transaction['QTY']
-			else:
-				print('unhandled transaction type {0}'.format(transaction['TRANTYP']))
-
+		quantity = net_quantity.get(entry[2], 0)
 		if entry[3] != quantity:
 			print('quantity not matched for {0}: {1}, {2}'.
 					format(entry[2], entry[3], quantity))
-			bad_isin_list.append(entry[2])
+			bad_isin_list.add(entry[2])
 
+	partial_matches = find_partial_matches(transaction_list, match_status, bad_isin_list)
 	matched_transaction_list = []
 	for transaction in transaction_list:
-		if not transaction['SCTYID_ISIN'] in bad_isin_list:
+		if not transaction['SCTYID_ISIN'] in bad_isin_list \
+			or id(transaction) in partial_matches:
 			matched_transaction_list.append(transaction)
 
 	return matched_transaction_list, bad_isin_list
 
 
 
+def find_partial_matches(transaction_list, match_status, bad_isin_list):
+	"""
+	For each ISIN in bad_isin_list, find the subset of its transactions
+	that explains most of the difference in the match status.
+
+	Return the set of id() of the transactions in those subsets. Their
+	records are not checked by verify_records(), so they are logged here
+	and flagged again there, to be reviewed before upload.
+	"""
+	transactions_by_isin = {}
+	for transaction in transaction_list:
+		if transaction['SCTYID_ISIN'] in bad_isin_list:
+			transactions_by_isin.setdefault(transaction['SCTYID_ISIN'], []).append(transaction)
+
+	partial_matches = set()
+	for entry in match_status:
+		transactions = transactions_by_isin.get(entry[2], [])
+		if len(transactions) == 0:
+			continue
+
+		quantities = [get_signed_quantity(transaction) for transaction in transactions]
+		indices, residual = find_matching_subset(quantities, entry[3])
+		if len(indices) == 0:
+			continue
+
+		print('{0}: {1} of {2} transactions matched, residual {3}'.
+				format(entry[2], len(indices), len(transactions), residual))
+		for i in indices:
+			logger.warning('find_partial_matches(): {0} transaction of quantity {1} kept as a partial match'.
+							format(entry[2], quantities[i]))
+			partial_matches.add(id(transactions[i]))
+
+	return partial_matches
+
+
+
 def verify_records(match_status, records, bad_isin_list):
+	"""
+	Check the net quantity of records of each ISIN is the difference in the
+	match status, ISIN codes in bad_isin_list are not checked. Records of
+	those ISIN codes come from partial matches (see find_partial_matches()),
+	they are flagged as not verified.
+
+	Note: only works for HTM portfolios.
+	"""
+	net_quantity = get_record_net_quantity(records)
 	for entry in match_status:
 		if entry[2] in bad_isin_list:
+			if entry[2] + ' HTM' in net_quantity:
+				print('{0}: partial match records not verified, net quantity {1}'.
+						format(entry[2], net_quantity[entry[2] + ' HTM']))
+				logger.warning('verify_records(): {0} partial match records not verified'.
+								format(entry[2]))
 			continue
 
-		quantity = 0
-		for record in filter_record_by_isin(entry[2], records):
-			if record['RecordType'] == 'Buy':
-				quantity = quantity - record['Quantity']
-			elif record['RecordType'] == 'Sell':
-				quantity = quantity + record['Quantity']
-			else:
-				print('unhandled record type {0}'.format(record['RecordType']))
-
+		quantity = net_quantity.get(entry[2] + ' HTM', 0)
 		if entry[3] != quantity:
 			print('quantity not matched for {0}: {1}, {2}'.
 					format(entry[2], entry[3], quantity))
@@ -693,20 +920,55 @@ def generate_match_records(match_file, transaction_file):
 	From the match status file and the transaction file, create the list of
 	records that fix the unmatched positions.
 	"""
-	match_status = read_match_status(match_file)
-	# print('{0} match status read'.format(len(match_status)))
-	# print('\n++++++++++++++++\n')
-	# for entry in match_status:
-	# 	print(entry)
+	return generate_batch_match_records([(match_file, transaction_file)])
+
 
+
+def read_recon_files(file_pair):
+	"""
+	Read the match status file and the transactions of the unmatched
+	positions in the transaction file.
+
+	file_pair: a tuple (match_file, transaction_file).
+
+	Return a tuple (match_status, transaction_list).
+	"""
+	match_file, transaction_file = file_pair
+	match_status = read_match_status(match_file)
 	isin_list = [entry[2] for entry in match_status]
 	transaction_list = []
 	read_transaction_file(transaction_file, isin_list, transaction_list)
-	matched_transaction_list, bad_isin_list = filter_matched_transaction(transaction_list, match_status)
+	return match_status, transaction_list
+
+
+
+def generate_batch_match_records(file_pairs, jobs=1):
+	"""
+	Same as calling generate_match_records() for each portfolio and joining
+	the records, but all files are read first, in parallel if jobs is more
+	than 1, then records of all portfolios are created in one go.
+
+	file_pairs: a list of (match_file, transaction_file), one for each
+	portfolio.
+	"""
+	matched_transaction_list = []
+	portfolio_results = []	# (match_status, bad_isin_list, start, count)
+	for match_status, transaction_list in map_files(read_recon_files, file_pairs, jobs):
+		matched, bad_isin_list = filter_matched_transaction(transaction_list, match_status)
+		portfolio_results.append((match_status, bad_isin_list,
+									len(matched_transaction_list), len(matched)))
+		matched_transaction_list.extend(matched)
+
 	records = convert_to_geneva_records(matched_transaction_list)
+
+	# key values start with the portfolio code, so doing it for all
+	# portfolios at once is the same as doing it for each portfolio.
 	fix_duplicate_key_value(records)
-	print('{0} records generated'.format(len(records)))
-	verify_records(match_status, records, bad_isin_list)
+
+	for match_status, bad_isin_list, start, count in portfolio_results:
+		print('{0} records generated'.format(count))
+		verify_records(match_status, records[start:start+count], bad_isin_list)
+
 	return records
 
 
@@ -727,8 +989,10 @@ if __name__ == '__main__':
 	6. TNDRL: buy back by issuer
 
 	If a position break has a difference of say, 100K, but the above transactions
-	found in the transaction file does not explain the difference, then they
-	are not extracted at all.
+	found in the transaction file does not explain the difference, then only
+	the subset of them that explains most of the difference is extracted, and
+	the residual is printed (see find_partial_matches()). Records of such
+	positions are not verified, check them before upload.
 	"""
 	# Do it over the command line
 	# parser = argparse.ArgumentParser(description='Read portfolio trades and create a Geneva trade upload file. Check the config file for path to trade files.')
@@ -753,12 +1017,18 @@ if __name__ == '__main__':
 	# Instead of getting from the command line, now read a list of position 
 	# break reports/transaction files from some where.
 	portfolios = ['12229', '12366', '12528', '12548', '12630', '12732', '12733']
-	records = []
-
+	file_pairs = []
 	for portfolio in portfolios:
 		match_file = os.path.join(get_input_directory(), '{0} match results 0118 morning.xlsx'.format(portfolio))
 		transaction_file = os.path.join(get_input_directory(), 'transactions {0} no initial pos.xls'.format(portfolio))
-		records = records + generate_match_records(match_file, transaction_file)
+		file_pairs.append((match_file, transaction_file))
+
+	try:
+		records = generate_batch_match_records(file_pairs,
+							jobs=min(len(file_pairs), os.cpu_count() or 1))
+	except:
+		dump_trace()
+		raise
 
 	print('{0} records'.format(len(records)))
 	write_csv(os.path.join(get_input_directory(), 'csa_upload.csv'), records)
@@ -0,0 +1,79 @@
+# coding=utf-8
+#
+# Cache portfolio reference data, i.e., accounting treatment, location
+# account, portfolio currency and FT portfolio currency, so that the lookup
+# for a portfolio is done only once per run, after that it is a dictionary
+# access.
+#
+
+from trade_converter.utility import logger
+from investment_lookup.id_lookup import get_portfolio_accounting_treatment
+
+
+
+# initialized only once when this module is first imported by others
+if not 'cache' in globals():
+	cache = {}
+	cache_stats = {'hit':0, 'miss':0}
+
+
+
+def get_portfolio_info(info_type, portfolio_id, lookup):
+	"""
+	Get a piece of reference data of a portfolio from the cache. If it is
+	not there, call lookup(portfolio_id) to get it and put it in the cache.
+
+	info_type: the type of reference data, e.g., 'LocationAccount'. The
+	same lookup function must always be used for the same info_type.
+
+	If the lookup raises an exception, nothing is cached and the exception
+	is passed to the caller.
+	"""
+	global cache, cache_stats
+	key = (info_type, portfolio_id)
+	try:
+		value = cache[key]
+		cache_stats['hit'] = cache_stats['hit'] + 1
+	except KeyError:
+		cache_stats['miss'] = cache_stats['miss'] + 1
+		value = lookup(portfolio_id)
+		cache[key] = value
+
+	return value
+
+
+
+def get_accounting_treatment(portfolio_id):
+	"""
+	Cached version of id_lookup.get_portfolio_accounting_treatment().
+	"""
+	return get_portfolio_info('AccountingTreatment', portfolio_id,
+								get_portfolio_accounting_treatment)
+
+
+
+def get_cache_stats():
+	"""
+	Return the number of cache hits and misses, as a dictionary like
+	{'hit':100, 'miss':3}.
+	"""
+	global cache_stats
+	return dict(cache_stats)
+
+
+
+def clear_cache(info_type=None):
+	"""
+	Remove cached reference data, e.g., after the lookup data is updated.
+	If info_type is given, only that type of reference data is removed.
+	The hit/miss counters are reset when the whole cache is cleared.
+	"""
+	global cache, cache_stats
+	logger.debug('clear_cache(): info_type={0}'.format(info_type))
+	if info_type is None:
+		cache.clear()
+		cache_stats['hit'] = 0
+		cache_stats['miss'] = 0
+	else:
+		for key in [key for key in cache if key[0] == info_type]:
+			del cache[key]
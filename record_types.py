@@ -0,0 +1,222 @@
+# coding=utf-8
+#
+# Compact row types for trades and Geneva records. A row type is a class
+# with one slot for each field, created at run time for a list of fields,
+# so a row keeps only its values, while the field names are kept once, in
+# the row type, instead of in every row as with a dictionary.
+#
+# Field names like 'Acct#' or 'KeyValue.KeyName' are not identifiers, so
+# each field gets an attribute name (see get_attribute_names()), e.g.,
+# 'Acct_' and 'KeyValue_KeyName'. Names that are already identifiers, like
+# 'KeyValue', are kept as is, so hot paths can use record.KeyValue, which
+# is as fast as a dictionary lookup.
+#
+# Rows support the part of the dictionary interface used by the converters,
+# i.e., row[fld], row[fld] = value, fld in row, get(), len(), keys(),
+# values() and items(), and a row is equal to a dictionary of the same
+# fields and values. row[fld] is a Python level call, so it is slower than
+# attribute access.
+#
+# A row of trade information keeps every column of the file header, rows
+# are not cut down to the columns a converter uses.
+#
+
+from trade_converter.utility import get_record_fields
+from operator import attrgetter
+import keyword
+
+
+
+# initialized only once when this module is first imported by others
+if not 'row_types' in globals():
+	row_types = {}	# tuple of fields -> row type
+	record_type = None
+
+
+
+class FieldRow(object):
+	"""
+	Base class of row types, see get_row_type(). A row is created with its
+	values in the order of the fields, values not given are None. Setting
+	a field not in the row type raises KeyError.
+	"""
+	__slots__ = ()
+	fields = ()
+	attributes = {}		# field -> attribute name
+
+	def __getitem__(self, fld):
+		return getattr(self, self.attributes[fld])
+
+	def __setitem__(self, fld, value):
+		setattr(self, self.attributes[fld], value)
+
+	def __contains__(self, fld):
+		return fld in self.attributes
+
+	def __len__(self):
+		return len(self.fields)
+
+	def __iter__(self):
+		return iter(self.fields)
+
+	def get(self, fld, default=None):
+		name = self.attributes.get(fld)
+		if name is None:
+			return default
+
+		return getattr(self, name)
+
+	def keys(self):
+		return list(self.fields)
+
+	def values(self):
+		return list(self.get_values(self))
+
+	def items(self):
+		return list(zip(self.fields, self.get_values(self)))
+
+	def to_dict(self):
+		return dict(zip(self.fields, self.get_values(self)))
+
+	def __eq__(self, other):
+		if isinstance(other, FieldRow):
+			return self.fields == other.fields and self.values() == other.values()
+		elif isinstance(other, dict):
+			return self.to_dict() == other
+		else:
+			return NotImplemented
+
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		if result is NotImplemented:
+			return result
+
+		return not result
+
+	__hash__ = None
+
+	def __repr__(self):
+		return repr(self.to_dict())
+
+	def __reduce__(self):
+		# row types are created at run time, so a row is pickled as its
+		# fields and values, e.g., when returned from a worker process.
+		return (make_row, (self.fields, self.values()))
+
+
+
+def get_attribute_names(fields):
+	"""
+	Return the list of attribute names of the fields. A character not
+	allowed in an identifier becomes '_', and a name that is a keyword,
+	used by FieldRow, or the same as a name before, gets more '_'.
+	"""
+	names = []
+	for fld in fields:
+		name = ''.join(c if c.isalnum() or c == '_' else '_' for c in fld)
+		if name == '' or name[0].isdigit():
+			name = 'f_' + name
+
+		while keyword.iskeyword(name) or hasattr(FieldRow, name) \
+			or name == 'get_values' or name in names:
+			name = name + '_'
+
+		names.append(name)
+
+	return names
+
+
+
+def get_row_type(fields):
+	"""
+	Return the row type for the list of fields, the same row type is
+	returned for the same fields.
+
+	The __init__ of the row type is generated from the attribute names, the
+	same way as collections.namedtuple(), so that creating a row does not
+	loop over the fields.
+	"""
+	global row_types
+	fields = tuple(fields)
+	try:
+		return row_types[fields]
+	except KeyError:
+		names = get_attribute_names(fields)
+		namespace = {}
+		source = 'def __init__(self{0}):\n\tpass\n'.format(
+					''.join(', {0}=None'.format(name) for name in names)) \
+					+ ''.join('\tself.{0} = {0}\n'.format(name) for name in names)
+		exec(source, namespace)
+
+		if len(names) == 1:
+			get_one = attrgetter(names[0])
+			get_values = lambda row: (get_one(row),)
+		else:
+			get_values = attrgetter(*names)
+
+		row_type = type('FieldRow{0}'.format(len(row_types)), (FieldRow,),
+						{'__slots__':tuple(names), '__init__':namespace['__init__'],
+						'fields':fields, 'attributes':dict(zip(fields, names)),
+						'get_values':staticmethod(get_values)})
+		row_types[fields] = row_type
+		return row_type
+
+
+
+def make_row(fields, values):
+	return get_row_type(fields)(*values)
+
+
+
+def empty_record():
+	"""
+	Return an empty Geneva record, whose fields are get_record_fields().
+	"""
+	return get_record_type()()
+
+
+
+def get_record_type():
+	"""
+	The row type of Geneva records, see empty_record().
+	"""
+	global record_type
+	if record_type is None:
+		record_type = get_row_type(get_record_fields())
+
+	return record_type
+
+
+
+def compile_record_builder(known_fields, extractors, record_fields=None):
+	"""
+	Return a function build_record(trade_info) that creates a Geneva record
+	from a trade.
+
+	known_fields: a dictionary of fields with constant values, they are
+	put into each new record. The values must not be changed later, e.g.,
+	lists are shared by records.
+
+	extractors: a dictionary mapping a field to a function taking the trade
+	and the record being built, returning the field value. The functions
+	are called in the order of the record fields, so a function can use
+	fields before it, e.g., 'ActualSettleDate' uses 'SettleDate'.
+
+	record_fields: fields of the record, get_record_fields() if not given.
+	"""
+	if record_fields is None:
+		record_fields = get_record_fields()
+
+	row_type = get_row_type(record_fields)
+	template = [known_fields.get(fld) for fld in record_fields]
+	steps = [(row_type.attributes[fld], extractors[fld]) for fld in record_fields \
+				if fld in extractors]
+
+	def build_record(trade_info):
+		record = row_type(*template)
+		for name, extract in steps:
+			setattr(record, name, extract(trade_info, record))
+
+		return record
+
+	return build_record
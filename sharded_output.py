@@ -0,0 +1,156 @@
+# coding=utf-8
+#
+# Write records to several smaller upload files (shards) instead of one big
+# file, so that Geneva can import them in parallel, and when a shard fails
+# only that shard needs to be imported again.
+#
+# Records are split by Portfolio and/or EventDate, and a shard is split
+# again if it has more than a maximum number of records. Shards are written
+# to a directory together with a manifest file, upload_manifest.csv, which
+# lists the shards in import order, i.e., by trade date, then portfolio.
+#
+
+from trade_converter.utility import logger
+from concurrent.futures import ThreadPoolExecutor
+import csv, os
+
+
+
+class InvalidShardField(Exception):
+	pass
+
+
+
+shard_fields = ['Portfolio', 'EventDate']
+
+
+
+def get_date_order(event_date):
+	"""
+	Sort key of a date string in the 'yyyy-m-d' format.
+	"""
+	try:
+		return tuple(int(x) for x in event_date.split('-'))
+	except (AttributeError, ValueError):
+		return (event_date,)
+
+
+
+def split_shards(records, shard_by=None, max_records=0):
+	"""
+	Split the records into shards, return the list of (shard_key, records)
+	in import order.
+
+	shard_by: a list of fields from shard_fields, records with the same
+	values of those fields are in the same shard. If not given, all records
+	are in one shard.
+
+	max_records: if more than 0, a shard has at most that many records,
+	the rest go to the next part of the shard.
+
+	shard_key is a dictionary like {'Portfolio':'12229', 'EventDate':
+	'2016-1-28', 'Part':1}. Records keep their order within a shard.
+	"""
+	if shard_by is None:
+		shard_by = []
+
+	for fld in shard_by:
+		if not fld in shard_fields:
+			logger.error('split_shards(): cannot shard by {0}'.format(fld))
+			raise InvalidShardField()
+
+	groups = {}
+	for record in records:
+		groups.setdefault(tuple(record[fld] for fld in shard_by), []).append(record)
+
+	def import_order(values):
+		key = dict(zip(shard_by, values))
+		return (get_date_order(key.get('EventDate', '')), key.get('Portfolio', ''))
+
+	shards = []
+	for values in sorted(groups, key=import_order):
+		group = groups[values]
+		if max_records > 0:
+			parts = [group[i:i+max_records] for i in range(0, len(group), max_records)]
+		else:
+			parts = [group]
+
+		for part, shard_records in enumerate(parts, start=1):
+			shard_key = dict(zip(shard_by, values))
+			shard_key['Part'] = part
+			shards.append((shard_key, shard_records))
+
+	return shards
+
+
+
+def get_shard_file_name(prefix, order, shard_key):
+	"""
+	Shard file name, like trade_upload_0001_12229_2016-1-28_1.csv, the order
+	comes first so that sorting the names gives the import order too.
+	"""
+	names = [prefix, '{0:04d}'.format(order)]
+	for fld in shard_fields:
+		if fld in shard_key:
+			names.append(str(shard_key[fld]))
+
+	names.append(str(shard_key['Part']))
+	return '_'.join(names) + '.csv'
+
+
+
+def write_shards(directory, prefix, records, write_file, shard_by=None,
+					max_records=0, jobs=1):
+	"""
+	Split the records into shards (see split_shards()), write each shard
+	to a file in the directory with write_file(file, records), e.g.,
+	tc.write_csv(), then write the manifest file. Shard files of an earlier
+	run in the directory are removed first, see remove_shard_files().
+
+	jobs: number of threads to write shards at the same time.
+
+	Return the list of shard files, in import order.
+	"""
+	shards = split_shards(records, shard_by, max_records)
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+	else:
+		remove_shard_files(directory, prefix)
+
+	manifest = []
+	for order, (shard_key, shard_records) in enumerate(shards, start=1):
+		file = os.path.join(directory, get_shard_file_name(prefix, order, shard_key))
+		manifest.append((order, file, shard_key, shard_records))
+
+	logger.debug('write_shards(): {0} shards, {1} jobs'.format(len(shards), jobs))
+	with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+		# list() to raise any error from writing a shard
+		list(executor.map(lambda entry: write_file(entry[1], entry[3]), manifest))
+
+	write_manifest(os.path.join(directory, 'upload_manifest.csv'), manifest)
+	return [entry[1] for entry in manifest]
+
+
+
+def remove_shard_files(directory, prefix):
+	"""
+	Remove the shard files (prefix_*.csv) and the manifest file in the
+	directory, so that shards of an earlier run are not imported together
+	with the new ones.
+	"""
+	for name in os.listdir(directory):
+		if (name.startswith(prefix + '_') and name.endswith('.csv')) \
+			or name == 'upload_manifest.csv':
+			logger.debug('remove_shard_files(): remove {0}'.format(name))
+			os.remove(os.path.join(directory, name))
+
+
+
+def write_manifest(manifest_file, manifest):
+	with open(manifest_file, 'w', newline='') as f:
+		file_writer = csv.writer(f)
+		file_writer.writerow(['Order', 'File'] + shard_fields + ['Part', 'Records'])
+		for order, file, shard_key, shard_records in manifest:
+			file_writer.writerow([order, os.path.basename(file)] +
+								[shard_key.get(fld, '') for fld in shard_fields] +
+								[shard_key['Part'], len(shard_records)])
@@ -5,20 +5,40 @@
 # 
 
 import csv, argparse, glob, os, sys
+from operator import itemgetter, attrgetter
 from trade_converter.utility import logger, get_current_path, get_record_fields, \
-									get_input_directory
-from trade_converter.port_12307 import convert12307
-from trade_converter.port_ft import convert_ft
-from trade_converter.port_12734 import convert12734
+									get_input_directory, dump_trace
+from trade_converter.port_12307 import convert12307, iter_convert12307
+from trade_converter.port_ft import convert_ft, iter_convert_ft
+from trade_converter.port_12734 import convert12734, iter_convert12734
+from trade_converter.workbook_reader import disable_parse_cache
+from trade_converter.record_types import get_row_type
+from trade_converter.columnar_output import iter_write_columnar
+from trade_converter.sharded_output import write_shards
+from trade_converter.file_manifest import get_manifest_file, load_manifest, \
+									save_manifest, find_changed_files, \
+									get_reserved_keys, update_manifest, \
+									remove_duplicate_files
 
 
 
-def get_converter(file_format):
-	func_map = {
-				'clamc':convert12307,
-				'12734':convert12734,
-				'ft':convert_ft
-				}
+def get_converter(file_format, stream=False):
+	"""
+	If stream is True, return the generator version of the converter, which
+	yields records one by one instead of returning a list.
+	"""
+	if stream:
+		func_map = {
+					'clamc':iter_convert12307,
+					'12734':iter_convert12734,
+					'ft':iter_convert_ft
+					}
+	else:
+		func_map = {
+					'clamc':convert12307,
+					'12734':convert12734,
+					'ft':convert_ft
+					}
 	return func_map[file_format]
 
 
@@ -33,45 +53,142 @@ def get_all_trade_files(directory):
 
 
 
-def write_csv(file, records):
-	with open(file, 'w', newline='') as csvfile:
-		logger.debug('write_csv(): {0}'.format(file))
-		file_writer = csv.writer(csvfile)
+def convert_incremental(file_format, folder, jobs=1, columnar_format=None,
+						shard_by=None, max_records=0):
+	"""
+	Convert only the trade files under the folder that are new or modified
+	since the last incremental run, write their records to the delta upload
+	file, then update the manifest of the folder.
 
-		fields = get_record_fields()
-		file_writer.writerow(fields[:-1] + ['TradeExpenses.ExpenseNumber', 'TradeExpenses.ExpenseCode',
-					'TradeExpenses.ExpenseAmt'])
+	New records do not get key values used by records converted before.
+	Only the new or modified files are hashed, and those with the same
+	content as another file are skipped (see find_changed_files()).
 
-		for record in records:
-			trade_expenses = record['trade_expenses']
-			if trade_expenses == []:
-				row = []
-				for fld in fields:
-					if fld == 'trade_expenses':
-						row = row + [' ', ' ', ' ']
-					else:
-						item = record[fld]
-						row.append(item)
+	columnar_format, shard_by, max_records: see write_output().
+	"""
+	manifest_file = get_manifest_file(folder)
+	manifest = load_manifest(manifest_file)
+	changed_files, duplicates = find_changed_files(get_all_trade_files(folder), manifest)
+	report_duplicate_files(duplicates)
+	files = [file for file, file_hash in changed_files]
+	print('{0} new or modified files'.format(len(files)))
+
+	records = []
+	record_sources = []
+	if len(files) > 0:
+		do_convert = get_converter(file_format)
+		records = do_convert(files, jobs=jobs, reserved_keys=get_reserved_keys(manifest, files),
+								record_sources=record_sources)
+
+	write_output(get_input_directory() + '\\trade_upload_delta.csv', records, columnar_format,
+					shard_by, max_records, jobs)
+
+	# update the manifest only after the delta file is written, so that
+	# the files are converted again if anything goes wrong.
+	update_manifest(manifest, changed_files, records, record_sources)
+	save_manifest(manifest_file, manifest)
 
-				file_writer.writerow(row)
 
-			else:
-				for expense_number in range(len(trade_expenses)):
-					row = []
-					for fld in fields:
-						if fld == 'trade_expenses':
-							row = row + [expense_number+1, trade_expenses[expense_number][0],
-											trade_expenses[expense_number][1]]
-							break
 
+def write_output(output_file, records, columnar_format=None, shard_by=None,
+					max_records=0, jobs=1):
+	"""
+	Write records to the csv file. If columnar_format ('parquet' or 'arrow')
+	is given, write them to a columnar file of the same name as well, e.g.,
+	trade_upload.parquet, in the same pass (see columnar_output.py).
+
+	If shard_by (a list of 'Portfolio', 'EventDate') or max_records is
+	given, records are written to shards in a directory of the same name
+	instead, e.g., trade_upload\\, with jobs threads (see sharded_output.py).
+	"""
+	if not columnar_format is None:
+		columnar_file = os.path.splitext(output_file)[0] + '.' + columnar_format
+		records = iter_write_columnar(records, columnar_file, columnar_format)
+
+	if (not shard_by is None and len(shard_by) > 0) or max_records > 0:
+		directory, prefix = os.path.split(os.path.splitext(output_file)[0])
+		files = write_shards(os.path.join(directory, prefix), prefix, records, write_csv,
+								shard_by, max_records, jobs)
+		print('{0} shards written'.format(len(files)))
+	else:
+		write_csv(output_file, records)
+
+
+
+def report_duplicate_files(duplicates):
+	"""
+	Print the files skipped because they are the same as another file,
+	duplicates being a list of (file, original_file).
+	"""
+	for file, original in duplicates:
+		print('{0} is skipped, it is the same as {1}'.format(
+				os.path.basename(file), os.path.basename(original)))
+
+
+
+def write_csv(file, records, batch_size=10000):
+	"""
+	Write records to the csv file, records can be a list or any iterable,
+	e.g., a generator from get_converter(file_format, stream=True).
+
+	A record with trade expenses takes one row for each expense, only the
+	first row has the other fields. Rows are written in batches of
+	batch_size through a large file buffer.
+
+	Rows are written to a temporary file, which is renamed to the file
+	only after all records are written, so that an error in the middle,
+	e.g., duplicate keys found when streaming, does not leave a partial
+	upload file.
+
+	Every row is in the order of the header, i.e., the record fields other
+	than trade_expenses, then the expense number, code and amount.
+	"""
+	fields = get_record_fields()
+	expense_position = fields.index('trade_expenses')
+	other_fields = fields[:expense_position] + fields[expense_position+1:]
+	get_values = itemgetter(*other_fields)
+	blank_values = [''] * len(other_fields)
+	record_type = get_row_type(fields)
+	get_row_values = attrgetter(*[record_type.attributes[fld] for fld in other_fields])
+	get_row_expenses = attrgetter(record_type.attributes['trade_expenses'])
+
+	temp_file = file + '.tmp'
+	try:
+		with open(temp_file, 'w', newline='', buffering=1024*1024) as csvfile:
+			logger.debug('write_csv(): {0}'.format(file))
+			file_writer = csv.writer(csvfile)
+			file_writer.writerow(other_fields + ['TradeExpenses.ExpenseNumber',
+									'TradeExpenses.ExpenseCode', 'TradeExpenses.ExpenseAmt'])
+
+			rows = []
+			for record in records:
+				if type(record) is record_type:
+					values = list(get_row_values(record))
+					trade_expenses = get_row_expenses(record)
+				else:
+					values = list(get_values(record))
+					trade_expenses = record['trade_expenses']
+
+				if trade_expenses == []:
+					rows.append(values + [' ', ' ', ' '])
+				else:
+					for expense_number, (code, amount) in enumerate(trade_expenses):
 						if expense_number == 0:
-							item = record[fld]
+							rows.append(values + [1, code, amount])
 						else:
-							item = ''
+							rows.append(blank_values + [expense_number+1, code, amount])
+
+				if len(rows) >= batch_size:
+					file_writer.writerows(rows)
+					rows = []
 
-						row.append(item)
+			file_writer.writerows(rows)
+	except:
+		if os.path.exists(temp_file):
+			os.remove(temp_file)
+		raise
 
-					file_writer.writerow(row)
+	os.replace(temp_file, file)
 
 
 
@@ -80,8 +197,25 @@ if __name__ == '__main__':
 	parser.add_argument('file_format')
 	parser.add_argument('--folder', help='folder containing multiple trade files', required=False)
 	parser.add_argument('--file', help='input trade file', required=False)
+	parser.add_argument('--jobs', help='number of processes to read trade files in parallel',
+						type=int, default=1, required=False)
+	parser.add_argument('--stream', help='write records as they are converted, to save memory (--jobs is ignored)',
+						action='store_true')
+	parser.add_argument('--no-cache', help='do not use the parse cache (see config file)',
+						action='store_true')
+	parser.add_argument('--incremental', help='with --folder, convert only new or modified files to trade_upload_delta.csv',
+						action='store_true')
+	parser.add_argument('--columnar', help='also write records to a Parquet or Arrow file (needs pyarrow)',
+						choices=['parquet', 'arrow'], required=False)
+	parser.add_argument('--shard-by', help='write records to one file per portfolio and/or trade date, with a manifest',
+						nargs='+', choices=['Portfolio', 'EventDate'], required=False)
+	parser.add_argument('--max-records', help='write records to files of at most this many records, with a manifest',
+						type=int, default=0, required=False)
 	args = parser.parse_args()
 
+	if args.no_cache:
+		disable_parse_cache()
+
 	if not args.file is None:
 		file = get_input_directory() + '\\' + args.file
 		if not os.path.exists(file):
@@ -94,13 +228,34 @@ if __name__ == '__main__':
 			print('{0} is not a valid directory'.format(folder))
 			sys.exit(1)
 
-		files = get_all_trade_files(folder)
+		if not args.incremental:
+			# in incremental mode, only the new or modified files are checked
+			# for duplicates, see convert_incremental()
+			files, duplicates = remove_duplicate_files(get_all_trade_files(folder))
+			report_duplicate_files(duplicates)
 	else:
 		print('Please provide either --file or --folder input')
 		sys.exit(1)
 
-	do_convert = get_converter(args.file_format)
-	records = do_convert(files)
+	if args.incremental and (args.folder is None or args.stream):
+		print('--incremental works only with --folder, and not with --stream')
+		sys.exit(1)
+
+	try:
+		if args.incremental:
+			convert_incremental(args.file_format, folder, args.jobs, args.columnar,
+								args.shard_by, args.max_records)
+		else:
+			if args.stream:
+				do_convert = get_converter(args.file_format, stream=True)
+				records = do_convert(files)
+			else:
+				do_convert = get_converter(args.file_format)
+				records = do_convert(files, jobs=args.jobs)
 
-	output_file = get_input_directory() + '\\trade_upload.csv'
-	write_csv(output_file, records)
\ No newline at end of file
+			output_file = get_input_directory() + '\\trade_upload.csv'
+			write_output(output_file, records, args.columnar, args.shard_by,
+							args.max_records, args.jobs)
+	except:
+		dump_trace()
+		raise
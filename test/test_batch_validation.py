@@ -0,0 +1,102 @@
+"""
+Test the batch_validation.py
+"""
+
+import unittest2
+from xlrd import open_workbook
+from trade_converter.utility import get_current_path, is_blank_line
+from trade_converter.port_ft import read_data_fields, read_line, \
+                                    validate_trade_info, InvalidTradeInfo
+from trade_converter.port_12307 import read_trade_file
+from trade_converter.batch_validation import validate_ft_trades, \
+                                            validate_12307_trades, check_trades, \
+                                            np, InvalidTradeInfo as BatchInvalidTradeInfo
+
+
+
+@unittest2.skipIf(np is None, 'NumPy is not installed')
+class TestBatchValidation(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestBatchValidation, self).__init__(*args, **kwargs)
+
+
+
+    def read_ft_trades(self, filename):
+        wb = open_workbook(filename=get_current_path() + filename)
+        ws = wb.sheet_by_index(0)
+        fields = read_data_fields(ws, 0)
+        trades = []
+        for row in range(1, ws.nrows):
+            if is_blank_line(ws, row):
+                break
+
+            trade_info = read_line(ws, row, fields)
+            if not trade_info is None:
+                trades.append(trade_info)
+
+        return trades
+
+
+
+    def is_valid(self, trade_info):
+        try:
+            validate_trade_info(trade_info)
+            return True
+        except InvalidTradeInfo:
+            return False
+
+
+
+    def test_ft_error(self):
+        """
+        The result is the same as validating row by row.
+        """
+        trades = self.read_ft_trades('\\samples\\sample_FT_error.xlsx')
+        mask, diagnostics = validate_ft_trades(trades)
+        self.assertEqual(list(mask), [self.is_valid(trade_info) for trade_info in trades])
+        self.assertTrue(len(diagnostics) > 0)
+        self.assertFalse(mask.all())
+
+
+
+    def test_ft(self):
+        trades = self.read_ft_trades('\\samples\\sample_FT_12229.xls')
+        mask, diagnostics = validate_ft_trades(trades)
+        self.assertTrue(mask.all())
+        self.assertEqual(diagnostics, {})
+
+        trades[1]['GROSSLCL'] = trades[1]['GROSSLCL'] + 1
+        trades[2]['QTY'] = 'abc'
+        mask, diagnostics = validate_ft_trades(trades)
+        self.assertEqual(list(mask.nonzero()[0]), [0] + list(range(3, len(trades))))
+        self.assertEqual(list(diagnostics['fx']), [1])
+        self.assertEqual(list(diagnostics['type']), [2])
+        self.assertFalse('price' in diagnostics)
+
+
+
+    def test_12307(self):
+        trades = read_trade_file(get_current_path() + '\\samples\\12307-20161111.xls')
+        mask, diagnostics = validate_12307_trades(trades)
+        self.assertTrue(mask.all())
+
+        trades[0]['Net Setl'] = trades[0]['Net Setl'] + 1
+        trades[1]['B/S'] = 'X'
+        mask, diagnostics = validate_12307_trades(trades)
+        self.assertEqual(list(diagnostics['net_settlement']), [0])
+        self.assertEqual(list(diagnostics['instruction']), [1])
+
+
+
+    def test_check_trades(self):
+        trades = self.read_ft_trades('\\samples\\sample_FT_12229.xls')
+        trades[1]['GROSSLCL'] = trades[1]['GROSSLCL'] + 1
+        self.assertEqual(check_trades(trades, validate_ft_trades, ['ACCT_ACNO', 'SCTYID_ISIN'],
+                                        'sample_FT_12229.xls'), 1)
+
+        # a value not a number
+        trades[2]['FXRATE'] = ''
+        with self.assertRaises(BatchInvalidTradeInfo):
+            check_trades(trades, validate_ft_trades, ['ACCT_ACNO', 'SCTYID_ISIN'],
+                            'sample_FT_12229.xls')
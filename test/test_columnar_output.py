@@ -0,0 +1,85 @@
+"""
+Test the columnar_output.py
+"""
+
+import unittest2, tempfile, shutil, os
+from trade_converter.utility import get_current_path
+from trade_converter.port_ft import convert_ft
+from trade_converter.columnar_output import write_columnar, pa
+
+
+
+@unittest2.skipIf(pa is None, 'pyarrow is not installed')
+class TestColumnarOutput(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestColumnarOutput, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        self.directory = tempfile.mkdtemp()
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        shutil.rmtree(self.directory)
+
+
+
+    def create_records(self):
+        records = convert_ft([get_current_path() + '\\samples\\sample_FT_12229.xls'])
+        records[0]['trade_expenses'] = [('Stamp_Duty', 10.5), ('Misc_Fee', 2)]
+        records[1]['CounterTDateFx'] = ''
+        return records
+
+
+
+    def verify_table(self, table, records):
+        self.assertEqual(table.num_rows, len(records))
+        self.assertEqual(table.column('KeyValue').to_pylist(),
+                            [record['KeyValue'] for record in records])
+        self.assertEqual(table.column('Quantity').to_pylist(),
+                            [record['Quantity'] for record in records])
+        self.assertEqual(table.column('CounterTDateFx')[1].as_py(), None)
+        self.assertEqual(table.column('trade_expenses')[0].as_py(),
+                            [{'code':'Stamp_Duty', 'amount':10.5}, {'code':'Misc_Fee', 'amount':2.0}])
+        self.assertEqual(table.column('trade_expenses')[1].as_py(), [])
+
+
+
+    def test_parquet(self):
+        import pyarrow.parquet as pq
+        records = self.create_records()
+        file = os.path.join(self.directory, 'trade_upload.parquet')
+        write_columnar(file, iter(records), batch_size=2)
+        self.verify_table(pq.read_table(file), records)
+
+
+
+    def test_arrow(self):
+        records = self.create_records()
+        file = os.path.join(self.directory, 'trade_upload.arrow')
+        write_columnar(file, records, 'arrow')
+        with pa.memory_map(file) as source:
+            self.verify_table(pa.ipc.open_file(source).read_all(), records)
+
+
+
+    def test_error(self):
+        """
+        An error in the middle of the records leaves no partial file.
+        """
+        def iter_records():
+            for record in self.create_records():
+                yield record
+            raise ValueError()
+
+        file = os.path.join(self.directory, 'trade_upload.parquet')
+        with self.assertRaises(ValueError):
+            write_columnar(file, iter_records(), batch_size=1)
+        self.assertEqual(os.listdir(self.directory), [])
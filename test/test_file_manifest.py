@@ -0,0 +1,118 @@
+"""
+Test the file_manifest.py
+"""
+
+import unittest2, tempfile, shutil, os
+from trade_converter.file_manifest import load_manifest, save_manifest, \
+                                            find_changed_files, get_reserved_keys, \
+                                            update_manifest, remove_duplicate_files
+from trade_converter.port_12307 import fix_duplicate_key_value
+
+
+
+class TestFileManifest(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestFileManifest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        self.directory = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.directory, 'tc_manifest.json')
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        shutil.rmtree(self.directory)
+
+
+
+    def write_file(self, name, content):
+        file = os.path.join(self.directory, name)
+        with open(file, 'w') as f:
+            f.write(content)
+
+        return file
+
+
+
+    def convert(self, changed_files, manifest):
+        """
+        Pretend each file has one record, whose key value is 'x'.
+        """
+        files = [file for file, file_hash in changed_files]
+        records = [{'KeyValue':'x'} for file in files]
+        fix_duplicate_key_value(records, registry_file='',
+                                reserved_keys=get_reserved_keys(manifest, files))
+        update_manifest(manifest, changed_files, records, files)
+        return records
+
+
+
+    def test_incremental_run(self):
+        file1 = self.write_file('a.xls', 'trade 1')
+        manifest = load_manifest(self.manifest_file)
+        self.assertEqual(manifest, {})
+
+        changed_files, duplicates = find_changed_files([file1], manifest)
+        self.assertEqual(len(changed_files), 1)
+        records = self.convert(changed_files, manifest)
+        self.assertEqual(records[0]['KeyValue'], 'x')
+        save_manifest(self.manifest_file, manifest)
+
+        # second run, a new file comes in
+        file2 = self.write_file('b.xls', 'trade 2')
+        manifest = load_manifest(self.manifest_file)
+        changed_files, duplicates = find_changed_files([file1, file2], manifest)
+        self.assertEqual([file for file, file_hash in changed_files], [file2])
+        records = self.convert(changed_files, manifest)
+        self.assertEqual(records[0]['KeyValue'], 'x_1')
+        self.assertEqual(manifest['b.xls']['keys'], ['x_1'])
+
+
+
+    def test_modified_file(self):
+        file1 = self.write_file('a.xls', 'trade 1')
+        manifest = {}
+        self.convert(find_changed_files([file1], manifest)[0], manifest)
+
+        # same content, only the modification time changes
+        os.utime(file1, (0, 0))
+        self.assertEqual(find_changed_files([file1], manifest), ([], []))
+        self.assertEqual(manifest['a.xls']['mtime'], 0)
+
+        # content changes, it is converted again and keeps its key value
+        self.write_file('a.xls', 'trade 1 amended')
+        changed_files, duplicates = find_changed_files([file1], manifest)
+        self.assertEqual(len(changed_files), 1)
+        records = self.convert(changed_files, manifest)
+        self.assertEqual(records[0]['KeyValue'], 'x')
+
+
+
+    def test_duplicate_files(self):
+        file1 = self.write_file('a.xls', 'trade 1')
+        file2 = self.write_file('b.xls', 'trade 2')
+        file3 = self.write_file('c.xls', 'trade 1')
+        self.assertEqual(remove_duplicate_files([file1, file2, file3]),
+                            ([file1, file2], [(file3, file1)]))
+
+
+
+    def test_duplicate_of_converted_file(self):
+        file1 = self.write_file('a.xls', 'trade 1')
+        manifest = {}
+        self.convert(find_changed_files([file1], manifest)[0], manifest)
+
+        # the same file is sent again under another name
+        file2 = self.write_file('b.xls', 'trade 1')
+        changed_files, duplicates = find_changed_files([file1, file2], manifest)
+        self.assertEqual(changed_files, [])
+        self.assertEqual(duplicates, [(file2, 'a.xls')])
+        self.assertEqual(manifest['b.xls']['duplicate_of'], 'a.xls')
+        self.assertEqual(find_changed_files([file1, file2], manifest), ([], []))
@@ -0,0 +1,70 @@
+"""
+Test the investment_resolver.py
+"""
+
+import unittest2
+import trade_converter.investment_resolver as investment_resolver
+from trade_converter.investment_resolver import resolve_investment_ids, \
+                                                get_investment_id, \
+                                                clear_resolved_ids
+
+
+
+class TestInvestmentResolver(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestInvestmentResolver, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        clear_resolved_ids()
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        clear_resolved_ids()
+
+
+
+    def test_resolve_investment_ids(self):
+        keys = [('12229', 'ISIN', 'USY97279AB28'),
+                ('12229', 'ISIN', 'XX0000000000'),
+                ('12548', 'ISIN', 'XS0545110354'),
+                ('12229', 'ISIN', 'USY97279AB28'),
+                ('12229', 'ISIN', 'XX0000000000'),
+                ('12229', 'ISIN', 'XX0000000001')]
+        unresolved = resolve_investment_ids(keys)
+        self.assertEqual(unresolved, [('12229', 'ISIN', 'XX0000000000'),
+                                        ('12229', 'ISIN', 'XX0000000001')])
+        self.assertEqual(get_investment_id('12229', 'ISIN', 'USY97279AB28'), 'USY97279AB28 HTM')
+        self.assertEqual(get_investment_id('12548', 'ISIN', 'XS0545110354'), 'XS0545110354 HTM')
+        self.assertEqual(get_investment_id('12229', 'ISIN', 'XX0000000000'), None)
+
+
+
+    def test_resolve_again(self):
+        resolve_investment_ids([('12229', 'ISIN', 'XX0000000000')])
+        unresolved = resolve_investment_ids([('12229', 'ISIN', 'XX0000000000')])
+        self.assertEqual(unresolved, [('12229', 'ISIN', 'XX0000000000')])
+
+
+
+    def test_lookup_error(self):
+        def lookup(portfolio_id, id_type, security_id):
+            raise IOError('lookup file not available')
+
+        get_investment_Ids = investment_resolver.get_investment_Ids
+        investment_resolver.get_investment_Ids = lookup
+        try:
+            with self.assertRaises(IOError):
+                resolve_investment_ids([('12229', 'ISIN', 'USY97279AB28')])
+        finally:
+            investment_resolver.get_investment_Ids = get_investment_Ids
+
+        # not remembered as not found
+        self.assertEqual(get_investment_id('12229', 'ISIN', 'USY97279AB28'), 'USY97279AB28 HTM')
@@ -0,0 +1,64 @@
+"""
+Test the key_registry.py
+"""
+
+import unittest2, tempfile, shutil, os
+from trade_converter.key_registry import assign_registered_keys
+
+
+
+class TestKeyRegistry(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestKeyRegistry, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        self.directory = tempfile.mkdtemp()
+        self.registry_file = os.path.join(self.directory, 'keys.db')
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        shutil.rmtree(self.directory)
+
+
+
+    def create_record(self, key_value, quantity):
+        return {'KeyValue':key_value, 'Quantity':quantity}
+
+
+
+    def get_keys(self, records):
+        return [record['KeyValue'] for record in records]
+
+
+
+    def test_assign_keys(self):
+        records = [self.create_record('x', 100), self.create_record('x', 200),
+                    self.create_record('x', 100)]
+        assign_registered_keys(records, self.registry_file)
+        self.assertEqual(self.get_keys(records), ['x', 'x_1', 'x_2'])
+        self.assertEqual(records[1]['UserTranId1'], 'x_1')
+
+
+
+    def test_rerun(self):
+        """
+        In the second run, the first trade is gone and a new trade comes in,
+        the remaining trades keep their keys.
+        """
+        records = [self.create_record('x', 100), self.create_record('x', 200),
+                    self.create_record('x', 300)]
+        assign_registered_keys(records, self.registry_file)
+        self.assertEqual(self.get_keys(records), ['x', 'x_1', 'x_2'])
+
+        records = [self.create_record('x', 400), self.create_record('x', 300),
+                    self.create_record('x', 200)]
+        assign_registered_keys(records, self.registry_file)
+        self.assertEqual(self.get_keys(records), ['x_3', 'x_2', 'x_1'])
@@ -194,6 +194,24 @@ class TestPort12307(unittest2.TestCase):
 
 
 
+    def test_fix_duplicate_key_value_many(self):
+        """
+        5000 records sharing 100 key values, 50 records per key. For timing
+        on more records, see benchmark_duplicate_keys() in port_12307.py.
+        """
+        records = []
+        for i in range(5000):
+            records.append({'KeyValue':'x{0}'.format(i%100), 'Investment':''})
+
+        fix_duplicate_key_value(records)
+        self.assertEqual(records[99]['KeyValue'], 'x99')
+        self.assertEqual(records[100]['KeyValue'], 'x0_1')
+        self.assertEqual(records[-1]['KeyValue'], 'x99_49')
+        self.assertEqual(records[-1]['UserTranId1'], 'x99_49')
+        self.assertEqual(len(set([record['KeyValue'] for record in records])), 5000)
+
+
+
     def test_convert12307(self):
         file = get_current_path() + '\\samples\\12307-20161111.xls'
         files = [file]
@@ -216,6 +234,19 @@ class TestPort12307(unittest2.TestCase):
 
 
 
+    def test_convert12307_jobs(self):
+        """
+        Files read in parallel give the same records as read one by one.
+        """
+        file1 = get_current_path() + '\\samples\\12307-20161111.xls'
+        file2 = get_current_path() + '\\samples\\12307-20161116.xls'
+        files = [file1, file2, file1]
+        records = convert12307(files)
+        self.assertEqual(len(records), 12)
+        self.assertEqual(convert12307(files, jobs=2), records)
+
+
+
     def verify_trade1(self, trade_info):
         """
         1st trade in \\samples\\12307-20161111.xls
@@ -105,6 +105,17 @@ class TestPort12734(unittest2.TestCase):
 
 
 
+    def test_convert_12734_jobs(self):
+        """
+        Files read in parallel give the same records as read one by one.
+        """
+        files = [get_current_path() + '\\samples\\bond_order_sample1.xls',
+                    get_current_path() + '\\samples\\bond_order_sample2.xls']
+        records = convert12734(files)
+        self.assertEqual(convert12734(files, jobs=2), records)
+
+
+
     def verify_bond_order1(self, record):
         self.assertEqual(len(record), 18)
         self.assertEqual(record['Form Serial No.'], 'GFI-10-1215')
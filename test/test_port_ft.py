@@ -8,7 +8,9 @@ from xlrd import open_workbook
 from trade_converter.utility import get_current_path, get_record_fields
 from trade_converter.port_ft import read_data_fields, read_line, \
                                     validate_trade_info, create_record, \
-                                    convert_ft
+                                    convert_ft, read_transaction_file, \
+                                    iter_convert_ft, iter_unique_trades
+from collections import Counter
 
 
 
@@ -91,6 +93,74 @@ class TestPortFT(unittest2.TestCase):
         self.assertEqual(len(records), 3)
         self.verify_record1(records[0])
         self.verify_record2(records[2])
+
+
+
+    def test_iter_convert_ft(self):
+        files = [get_current_path() + '\\samples\\sample_FT_12229.xls']
+        records = list(iter_convert_ft(files))
+        self.assertEqual(records, convert_ft(files))
+        self.verify_record1(records[0])
+        self.verify_record2(records[2])
+
+
+
+    def test_convert_ft_jobs(self):
+        """
+        Files read in parallel give the same records as read one by one.
+        """
+        file = get_current_path() + '\\samples\\sample_FT_12229.xls'
+        files = [file, get_current_path() + '\\samples\\ft_FX_transactions.xls', file]
+        records = convert_ft(files)
+        self.assertEqual(len(records), 6)
+        self.assertEqual(convert_ft(files, jobs=2), records)
+
+
+
+    def test_read_file_with_predicates(self):
+        output = []
+        read_transaction_file(get_current_path() + '\\samples\\sample_FT_12229.xls',
+                                output, {'ACCT_ACNO': lambda x: x == '12548'})
+        self.assertEqual(len(output), 1)
+        self.verify_trade_info4(output[0])
+
+
+
+    def test_duplicate_trades(self):
+        """
+        The same file given twice, as if two overlapping files.
+        """
+        file = get_current_path() + '\\samples\\sample_FT_12229.xls'
+        records = convert_ft([file])
+        self.assertEqual(convert_ft([file, file], duplicate_policy='drop'), records)
+        self.assertEqual(list(iter_convert_ft([file, file], duplicate_policy='drop')), records)
+
+        records2 = convert_ft([file, file], duplicate_policy='flag')
+        self.assertEqual(len(records2), 2*len(records))
+        self.assertEqual(records2[len(records)]['KeyValue'], records[0]['KeyValue'] + '_1')
+
+
+
+    def test_split_fills(self):
+        """
+        Two identical split fills in one file are both kept, only the ones
+        accounted for by an earlier file are dropped.
+        """
+        def fill(i):
+            return {'ACCT_ACNO':'12229', 'TRDDATE':datetime(2016,11,16), 'TRANTYP':'Purch',
+                    'SCTYID_ISIN':'XS1505143393', 'QTY':1000000.0, 'PRINB':980000.0,
+                    'ENTRDATE':datetime(2016,11,16), 'id':i}
+
+        fingerprints = Counter()
+        trades = list(iter_unique_trades([fill(1), fill(2)], 'drop', fingerprints))
+        self.assertEqual([trade_info['id'] for trade_info in trades], [1, 2])
+
+        # the next file has the same two fills and a third one
+        trades = list(iter_unique_trades([fill(3), fill(4), fill(5)], 'drop', fingerprints))
+        self.assertEqual([trade_info['id'] for trade_info in trades], [5])
+
+        trades = list(iter_unique_trades([fill(6), fill(7), fill(8), fill(9)], 'flag', fingerprints))
+        self.assertEqual(len(trades), 4)
         
 
 
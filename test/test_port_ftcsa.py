@@ -8,7 +8,9 @@ from xlrd import open_workbook
 from trade_converter.utility import get_current_path
 from trade_converter.port_ftcsa import read_match_status, read_transaction_file, \
                                         filter_matched_transaction, verify_records, \
-                                        convert_to_geneva_records
+                                        convert_to_geneva_records, \
+                                        generate_batch_match_records, \
+                                        get_transaction_net_quantity, find_matching_subset
 from trade_converter.port_12307 import fix_duplicate_key_value
 
 
@@ -69,9 +71,79 @@ class TestPortFTCSA(unittest2.TestCase):
 
         # from a IATSA transaction
         self.verify_record6(self.find_record(records, 'FR0013101599 HTM', 'Buy', 28000000))
+
+
+
+    def test_batch(self):
+        file_pairs = []
+        for portfolio in ['12229', '12366']:
+            file_pairs.append((get_current_path() + '\\samples\\{0} match results 0118 morning.xlsx'.format(portfolio),
+                                get_current_path() + '\\samples\\transactions {0} no initial pos.xls'.format(portfolio)))
+
+        records = generate_batch_match_records(file_pairs, jobs=2)
+        self.verify_record1(self.find_record(records, 'USG46715AB73 HTM', 'Buy', 3750000))
+        self.verify_record6(self.find_record(records, 'FR0013101599 HTM', 'Buy', 28000000))
  
 
 
+    def test_net_quantity(self):
+        transaction_list = [{'SCTYID_ISIN':'A', 'TRANTYP':'CSA', 'QTY':100},
+                            {'SCTYID_ISIN':'B', 'TRANTYP':'CALLED', 'QTY':50},
+                            {'SCTYID_ISIN':'A', 'TRANTYP':'IATSW', 'QTY':30}]
+        self.assertEqual(get_transaction_net_quantity(transaction_list), {'A':-70, 'B':50})
+        
+        match_status = [('12229', 'A HTM', 'A', -70), ('12229', 'B HTM', 'B', 40)]
+        matched, bad_isin_list = filter_matched_transaction(transaction_list, match_status)
+        self.assertEqual(matched, [transaction_list[0], transaction_list[2]])
+        self.assertEqual(bad_isin_list, {'B'})
+
+
+
+    def test_find_matching_subset(self):
+        self.assertEqual(find_matching_subset([100, -30, 50, 20], 70), ([0, 1], 0))
+        self.assertEqual(find_matching_subset([100, -30, 50, 20], 65), ([2], 15))
+        self.assertEqual(find_matching_subset([100, 50], 40), ([], 40))
+        self.assertEqual(find_matching_subset([-100, -50], -60), ([1], -10))
+
+        # 4 quantities, found by building the sums
+        self.assertEqual(find_matching_subset([40, 30, 20, 10, 5], 100), ([0, 1, 2, 3], 0))
+
+        # only a few sums are allowed, the best one found is returned
+        self.assertEqual(find_matching_subset([40, 30, 20, 10, 5], 100, max_states=3), ([0], 60))
+
+
+
+    def test_find_matching_subset_late(self):
+        """
+        Many distinct quantities, the answer is near the end of the list.
+        """
+        quantities = []
+        for i in range(40):
+            quantity = ((i*7919) % 4999 + 1)*1000.0 + (i % 4)*125.5
+            quantities.append(quantity if i % 3 else -quantity)
+
+        target = quantities[31] + quantities[35] + quantities[38]
+        indices, residual = find_matching_subset(quantities, target)
+        self.assertEqual(residual, 0)
+        self.assertAlmostEqual(sum(quantities[i] for i in indices), target)
+
+        # no exact answer, the search stops within the budget
+        indices, residual = find_matching_subset(quantities*10, 1.5)
+        self.assertEqual((indices, residual), ([], 1.5))
+
+
+
+    def test_partial_match(self):
+        transaction_list = [{'SCTYID_ISIN':'A', 'TRANTYP':'CSW', 'QTY':100},
+                            {'SCTYID_ISIN':'A', 'TRANTYP':'CALLED', 'QTY':50},
+                            {'SCTYID_ISIN':'A', 'TRANTYP':'CSW', 'QTY':20}]
+        match_status = [('12229', 'A HTM', 'A', 130)]
+        matched, bad_isin_list = filter_matched_transaction(transaction_list, match_status)
+        self.assertEqual(matched, [transaction_list[0], transaction_list[2]])
+        self.assertEqual(bad_isin_list, {'A'})
+
+
+
     def find_record(self, records, investment_id, r_type, quantity):
         for record in records:
             if record['Investment'] == investment_id \
@@ -0,0 +1,72 @@
+"""
+Test the portfolio_cache.py
+"""
+
+import unittest2
+from trade_converter.portfolio_cache import get_portfolio_info, \
+                                            get_cache_stats, clear_cache
+
+
+
+class TestPortfolioCache(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestPortfolioCache, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        clear_cache()
+        self.lookup_count = 0
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        clear_cache()
+
+
+
+    def lookup(self, portfolio_id):
+        self.lookup_count = self.lookup_count + 1
+        if portfolio_id == '99999':
+            raise KeyError(portfolio_id)
+
+        return 'HKD'
+
+
+
+    def test_get_portfolio_info(self):
+        for i in range(3):
+            self.assertEqual(get_portfolio_info('Test', '12229', self.lookup), 'HKD')
+
+        self.assertEqual(self.lookup_count, 1)
+        self.assertEqual(get_cache_stats(), {'hit':2, 'miss':1})
+
+
+
+    def test_lookup_error(self):
+        with self.assertRaises(KeyError):
+            get_portfolio_info('Test', '99999', self.lookup)
+
+        with self.assertRaises(KeyError):
+            get_portfolio_info('Test', '99999', self.lookup)
+
+        self.assertEqual(self.lookup_count, 2)
+
+
+
+    def test_clear_cache(self):
+        get_portfolio_info('Test', '12229', self.lookup)
+        get_portfolio_info('Test2', '12229', self.lookup)
+        clear_cache('Test')
+        get_portfolio_info('Test', '12229', self.lookup)
+        get_portfolio_info('Test2', '12229', self.lookup)
+        self.assertEqual(self.lookup_count, 3)
+        self.assertEqual(get_cache_stats(), {'hit':1, 'miss':3})
+
+        clear_cache()
+        self.assertEqual(get_cache_stats(), {'hit':0, 'miss':0})
@@ -0,0 +1,74 @@
+"""
+Test the record_types.py
+"""
+
+import unittest2, pickle
+from trade_converter.record_types import get_row_type, empty_record, \
+                                        compile_record_builder
+
+
+
+class TestRecordTypes(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestRecordTypes, self).__init__(*args, **kwargs)
+
+
+
+    def test_row(self):
+        row_type = get_row_type(['Acct#', 'Trd Dt', 'B/S'])
+        self.assertTrue(get_row_type(['Acct#', 'Trd Dt', 'B/S']) is row_type)
+
+        row = row_type()
+        row['Acct#'] = '12307'
+        row['B/S'] = 'B'
+        self.assertEqual(row['Acct#'], '12307')
+        self.assertEqual(row.get('Trd Dt'), None)
+        self.assertEqual(row.get('ISIN', ''), '')
+        self.assertTrue('B/S' in row)
+        self.assertFalse('ISIN' in row)
+        self.assertEqual(row, {'Acct#':'12307', 'Trd Dt':None, 'B/S':'B'})
+        with self.assertRaises(KeyError):
+            row['ISIN'] = 'US0000000000'
+
+        # fields are attributes too
+        self.assertEqual(row_type.attributes, {'Acct#':'Acct_', 'Trd Dt':'Trd_Dt', 'B/S':'B_S'})
+        self.assertEqual(row.Acct_, '12307')
+        row.B_S = 'S'
+        self.assertEqual(row['B/S'], 'S')
+        self.assertEqual(row_type('12307', None, 'B').values(), ['12307', None, 'B'])
+
+
+
+    def test_attribute_names(self):
+        row_type = get_row_type(['KeyValue', 'KeyValue.KeyName', 'KeyValue_KeyName',
+                                    'get', 'class', '1st'])
+        self.assertEqual([row_type.attributes[fld] for fld in row_type.fields],
+                            ['KeyValue', 'KeyValue_KeyName', 'KeyValue_KeyName_',
+                            'get_', 'class_', 'f_1st'])
+        row = row_type(*range(6))
+        self.assertEqual(row['get'], 3)
+        self.assertEqual(row.get('get'), 3)
+
+
+
+    def test_record(self):
+        record = empty_record()
+        self.assertEqual(len(record), 27)
+        record['KeyValue'] = 'x'
+        record2 = pickle.loads(pickle.dumps(record))
+        self.assertEqual(record2, record)
+        self.assertEqual(record2['KeyValue'], 'x')
+        self.assertEqual(record2.KeyValue, 'x')
+
+
+
+    def test_record_builder(self):
+        build_record = compile_record_builder({'Strategy':'Default'},
+                        {'SettleDate':lambda trade_info, record: trade_info['date'],
+                        'ActualSettleDate':lambda trade_info, record: record['SettleDate']})
+        record = build_record({'date':'2016-11-16'})
+        self.assertEqual(len(record), 27)
+        self.assertEqual(record['Strategy'], 'Default')
+        self.assertEqual(record['ActualSettleDate'], '2016-11-16')
+        self.assertEqual(record['KeyValue'], None)
@@ -0,0 +1,100 @@
+"""
+Test the sharded_output.py
+"""
+
+import unittest2, tempfile, shutil, os, csv
+from trade_converter.tc import write_csv
+from trade_converter.record_types import empty_record
+from trade_converter.sharded_output import split_shards, write_shards, \
+                                            InvalidShardField
+
+
+
+class TestShardedOutput(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestShardedOutput, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        self.directory = tempfile.mkdtemp()
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        shutil.rmtree(self.directory)
+
+
+
+    def create_records(self):
+        records = []
+        for key_value, portfolio, event_date in [('1', '12229', '2016-10-2'),
+                                                ('2', '12307', '2016-9-30'),
+                                                ('3', '12229', '2016-10-2'),
+                                                ('4', '12229', '2016-9-30'),
+                                                ('5', '12229', '2016-10-2')]:
+            record = empty_record()
+            record['KeyValue'] = key_value
+            record['Portfolio'] = portfolio
+            record['EventDate'] = event_date
+            record['trade_expenses'] = []
+            records.append(record)
+
+        return records
+
+
+
+    def test_split_shards(self):
+        shards = split_shards(self.create_records(), ['Portfolio', 'EventDate'], 2)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual([shard_key for shard_key, records in shards],
+                            [{'Portfolio':'12229', 'EventDate':'2016-9-30', 'Part':1},
+                            {'Portfolio':'12307', 'EventDate':'2016-9-30', 'Part':1},
+                            {'Portfolio':'12229', 'EventDate':'2016-10-2', 'Part':1},
+                            {'Portfolio':'12229', 'EventDate':'2016-10-2', 'Part':2}])
+        self.assertEqual([[record['KeyValue'] for record in records] for shard_key, records in shards],
+                            [['4'], ['2'], ['1', '3'], ['5']])
+
+
+
+    def test_split_shards_error(self):
+        with self.assertRaises(InvalidShardField):
+            split_shards(self.create_records(), ['ISIN'])
+
+
+
+    def test_write_shards(self):
+        directory = os.path.join(self.directory, 'trade_upload')
+        files = write_shards(directory, 'trade_upload', self.create_records(),
+                                write_csv, ['EventDate'], jobs=2)
+        self.assertEqual([os.path.basename(file) for file in files],
+                            ['trade_upload_0001_2016-9-30_1.csv', 'trade_upload_0002_2016-10-2_1.csv'])
+        with open(files[1], newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual([row[2] for row in rows[1:]], ['1', '3', '5'])
+
+        with open(os.path.join(directory, 'upload_manifest.csv'), newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows, [['Order', 'File', 'Portfolio', 'EventDate', 'Part', 'Records'],
+                                ['1', 'trade_upload_0001_2016-9-30_1.csv', '', '2016-9-30', '1', '2'],
+                                ['2', 'trade_upload_0002_2016-10-2_1.csv', '', '2016-10-2', '1', '3']])
+
+
+
+    def test_write_shards_again(self):
+        directory = os.path.join(self.directory, 'trade_upload')
+        write_shards(directory, 'trade_upload', self.create_records(),
+                        write_csv, ['Portfolio', 'EventDate'])
+        self.assertEqual(len(os.listdir(directory)), 4)
+
+        # fewer shards, files of the first run are removed
+        files = write_shards(directory, 'trade_upload', self.create_records(),
+                                write_csv, ['Portfolio'])
+        self.assertEqual(sorted(os.listdir(directory)),
+                            sorted([os.path.basename(file) for file in files] + ['upload_manifest.csv']))
+        self.assertEqual(len(files), 2)
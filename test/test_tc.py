@@ -0,0 +1,107 @@
+"""
+Test the tc.py
+"""
+
+import unittest2, tempfile, shutil, os, csv
+from trade_converter.utility import get_record_fields
+from trade_converter.record_types import empty_record, get_row_type
+import trade_converter.tc as tc
+from trade_converter.tc import write_csv
+
+
+
+class TestTC(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestTC, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        self.directory = tempfile.mkdtemp()
+        self.file = os.path.join(self.directory, 'trade_upload.csv')
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        shutil.rmtree(self.directory)
+
+
+
+    def create_record(self, key_value, trade_expenses):
+        record = empty_record()
+        for fld in get_record_fields():
+            record[fld] = fld + '_' + key_value
+
+        record['trade_expenses'] = trade_expenses
+        return record
+
+
+
+    def read_csv(self):
+        with open(self.file, newline='') as f:
+            return list(csv.reader(f))
+
+
+
+    def test_write_csv(self):
+        records = [self.create_record('1', []),
+                    self.create_record('2', [('Stamp_Duty', 10), ('Misc_Fee', 2)]),
+                    self.create_record('3', [])]
+
+        # records can be dictionaries too
+        records[2] = records[2].to_dict()
+        write_csv(self.file, iter(records), batch_size=2)
+        rows = self.read_csv()
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0][-4:], ['InvestmentAccruedInterest', 'TradeExpenses.ExpenseNumber',
+                                        'TradeExpenses.ExpenseCode', 'TradeExpenses.ExpenseAmt'])
+        self.assertEqual(rows[1][:3], ['RecordType_1', 'RecordAction_1', 'KeyValue_1'])
+        self.assertEqual(rows[1][-3:], [' ', ' ', ' '])
+        self.assertEqual(rows[2][2], 'KeyValue_2')
+        self.assertEqual(rows[2][-3:], ['1', 'Stamp_Duty', '10'])
+        self.assertEqual(rows[3], ['']*26 + ['2', 'Misc_Fee', '2'])
+        self.assertEqual(rows[4][2], 'KeyValue_3')
+
+
+
+    def test_write_csv_field_order(self):
+        """
+        Fields after trade_expenses are written before the expense columns,
+        the same as in the header.
+        """
+        get_record_fields = tc.get_record_fields
+        tc.get_record_fields = lambda: ['KeyValue', 'trade_expenses', 'Quantity']
+        try:
+            record = get_row_type(['KeyValue', 'trade_expenses', 'Quantity'])()
+            record['KeyValue'] = 'x1'
+            record['trade_expenses'] = [('Stamp_Duty', 10), ('Misc_Fee', 2)]
+            record['Quantity'] = 100
+            write_csv(self.file, [record, {'KeyValue':'x2', 'trade_expenses':[], 'Quantity':200}])
+        finally:
+            tc.get_record_fields = get_record_fields
+
+        self.assertEqual(self.read_csv(),
+                        [['KeyValue', 'Quantity', 'TradeExpenses.ExpenseNumber',
+                            'TradeExpenses.ExpenseCode', 'TradeExpenses.ExpenseAmt'],
+                        ['x1', '100', '1', 'Stamp_Duty', '10'],
+                        ['', '', '2', 'Misc_Fee', '2'],
+                        ['x2', '200', ' ', ' ', ' ']])
+
+
+
+    def test_write_csv_error(self):
+        """
+        An error in the middle of the records leaves no partial file.
+        """
+        def iter_records():
+            yield self.create_record('1', [])
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            write_csv(self.file, iter_records(), batch_size=1)
+        self.assertEqual(os.listdir(self.directory), [])
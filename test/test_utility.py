@@ -0,0 +1,69 @@
+"""
+Test the utility.py
+"""
+
+import unittest2
+from datetime import datetime
+import trade_converter.utility as utility
+from trade_converter.utility import get_cached_date, excel_date_to_datetime, \
+                                    mmddyyyy_to_datetime, convert_datetime_to_string, \
+                                    clear_date_cache
+
+
+
+class TestUtility(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestUtility, self).__init__(*args, **kwargs)
+
+
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        clear_date_cache()
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        clear_date_cache()
+
+
+
+    def test_cached_date(self):
+        calls = []
+        def decode(cell_value):
+            calls.append(cell_value)
+            return mmddyyyy_to_datetime(cell_value)
+
+        for i in range(3):
+            self.assertEqual(get_cached_date(6212013.0, decode), datetime(2013,6,21))
+            self.assertEqual(get_cached_date(12012016.0, decode), datetime(2016,12,1))
+
+        self.assertEqual(calls, [6212013.0, 12012016.0])
+
+
+
+    def test_excel_date(self):
+        self.assertEqual(get_cached_date(42705.0, excel_date_to_datetime), datetime(2016,12,1))
+        self.assertEqual(convert_datetime_to_string(datetime(2016,12,1)), '2016-12-1')
+        self.assertEqual(convert_datetime_to_string(datetime(2016,12,1)), '2016-12-1')
+
+
+
+    def test_date_cache_size(self):
+        date_cache_size = utility.date_cache_size
+        utility.date_cache_size = 2
+        try:
+            for cell_value in [42705.0, 42706.0, 42707.0]:
+                get_cached_date(cell_value, excel_date_to_datetime)
+            self.assertEqual(len(utility.date_cache), 1)
+        finally:
+            utility.date_cache_size = date_cache_size
+
+        clear_date_cache()
+        self.assertEqual(len(utility.date_cache), 0)
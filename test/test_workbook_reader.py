@@ -0,0 +1,137 @@
+"""
+Test the workbook_reader.py
+"""
+
+import unittest2, tempfile, shutil, os, csv, zipfile
+from trade_converter.utility import get_current_path
+from trade_converter.workbook_reader import open_worksheet, \
+                                            open_cached_worksheet, \
+                                            evict_cache_files, close_worksheet
+
+
+
+class TestWorkbookReader(unittest2.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(TestWorkbookReader, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        """
+            Run before a test function
+        """
+        self.directory = tempfile.mkdtemp()
+
+
+
+    def tearDown(self):
+        """
+            Run after a test finishes
+        """
+        shutil.rmtree(self.directory)
+
+
+
+    def verify_same_values(self, ws1, ws2):
+        self.assertEqual(ws1.nrows, ws2.nrows)
+        self.assertEqual(ws1.ncols, ws2.ncols)
+        for row in range(ws1.nrows):
+            self.assertEqual(ws1.row_values(row), ws2.row_values(row))
+            self.assertEqual(ws1.cell_value(row, 3), ws2.cell_value(row, 3))
+
+
+
+    def test_xlsx(self):
+        filename = get_current_path() + '\\samples\\sample_FT.xlsx'
+        self.verify_same_values(open_worksheet(filename, 'xlrd'),
+                                open_worksheet(filename, 'openpyxl'))
+
+
+
+    def test_xlsx_wrong_dimension(self):
+        import openpyxl
+        filename = os.path.join(self.directory, 'sample.xlsx')
+        wb = openpyxl.Workbook()
+        for row in range(5):
+            wb.active.append(['ISIN{0}'.format(row), row, 'x'])
+        wb.save(filename)
+
+        # a file whose dimension says 2 rows and 2 columns
+        bad_file = os.path.join(self.directory, 'bad_dimension.xlsx')
+        with zipfile.ZipFile(filename) as fin, zipfile.ZipFile(bad_file, 'w') as fout:
+            for item in fin.infolist():
+                data = fin.read(item.filename)
+                if item.filename == 'xl/worksheets/sheet1.xml':
+                    data = data.replace(b'<dimension ref="A1:C5"', b'<dimension ref="A1:B2"')
+                fout.writestr(item, data)
+
+        ws = open_worksheet(bad_file, 'openpyxl')
+        self.assertEqual((ws.nrows, ws.ncols), (5, 3))
+        self.assertEqual(ws.row_values(4), ['ISIN4', 4.0, 'x'])
+
+        # the workbook is closed after the last row is read
+        self.assertIsNone(ws.workbook._archive.fp)
+        self.assertEqual(ws.row_values(4), ['ISIN4', 4.0, 'x'])
+
+
+
+    def test_close_worksheet(self):
+        ws = open_worksheet(get_current_path() + '\\samples\\sample_FT.xlsx', 'openpyxl')
+        ws.row_values(1)
+        close_worksheet(ws)
+        self.assertIsNone(ws.workbook._archive.fp)
+
+        # xlrd worksheets have nothing to close
+        close_worksheet(open_worksheet(get_current_path() + '\\samples\\sample_FT.xlsx', 'xlrd'))
+
+
+
+    def test_csv(self):
+        ws = open_worksheet(get_current_path() + '\\samples\\sample_FT_12229.xls')
+        filename = os.path.join(self.directory, 'sample_FT_12229.csv')
+        with open(filename, 'w', newline='') as f:
+            file_writer = csv.writer(f)
+            for row in range(ws.nrows):
+                file_writer.writerow(ws.row_values(row))
+
+        self.verify_same_values(open_worksheet(get_current_path() + '\\samples\\sample_FT_12229.xls'),
+                                open_worksheet(filename))
+
+        # a short last row is padded, no file is kept open
+        with open(filename, 'a', newline='') as f:
+            f.write('1\n')
+        ws = open_worksheet(filename)
+        self.assertEqual(ws.row_values(ws.nrows - 1), [1.0] + [''] * (ws.ncols - 1))
+        self.assertFalse(hasattr(ws, 'file'))
+
+
+
+    def test_cache(self):
+        filename = get_current_path() + '\\samples\\sample_FT_12229.xls'
+        ws = open_cached_worksheet(filename, 'xlrd', self.directory)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.verify_same_values(open_worksheet(filename, 'xlrd'), ws)
+
+        # read again from the cache
+        ws = open_cached_worksheet(filename, 'xlrd', self.directory)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.verify_same_values(open_worksheet(filename, 'xlrd'), ws)
+
+        evict_cache_files(self.directory, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+
+    def test_bad_cache_file(self):
+        filename = get_current_path() + '\\samples\\sample_FT_12229.xls'
+        open_cached_worksheet(filename, 'xlrd', self.directory)
+        cache_file = os.path.join(self.directory, os.listdir(self.directory)[0])
+
+        # a pickle of a class that no longer exists
+        with open(cache_file, 'wb') as f:
+            f.write(b'cno_such_module\nRows\n.')
+
+        ws = open_cached_worksheet(filename, 'xlrd', self.directory)
+        self.verify_same_values(open_worksheet(filename, 'xlrd'), ws)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(cache_file)])
+        ws = open_cached_worksheet(filename, 'xlrd', self.directory)
+        self.verify_same_values(open_worksheet(filename, 'xlrd'), ws)
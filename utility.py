@@ -4,7 +4,11 @@
 # and a logger object (logging to a file).
 # 
 
-import configparser, os
+import configparser, os, logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from xlrd.xldate import xldate_as_datetime
 from config_logging.file_logger import get_file_logger
 
 
@@ -76,6 +80,59 @@ if not 'logger' in globals():
 
 
 
+def _setup_trace():
+	"""
+	The ring buffer for hot path debug messages, see trace().
+	"""
+	try:
+		size = int(config.get('logging', 'trace_size', fallback='0'))
+	except ValueError:
+		size = 0
+
+	return deque(maxlen=max(size, 0))
+
+
+
+# initialized only once when this module is first imported by others
+if not 'trace_buffer' in globals():
+	trace_buffer = _setup_trace()
+
+
+
+def trace(message, *args):
+	"""
+	Log a debug message from the hot path, i.e., code that runs for every
+	row or trade. The message is formatted as in logger.debug(message, *args),
+	but only when it is written out.
+
+	If the log level is debug, the message is logged directly. Otherwise it
+	is kept in a ring buffer of the last trace_size (see config file)
+	messages, which are written to the log file by dump_trace() when an
+	error happens.
+	"""
+	global trace_buffer
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug(message, *args)
+	elif trace_buffer.maxlen > 0:
+		trace_buffer.append((message, args))
+
+
+
+def dump_trace():
+	"""
+	Write the messages kept by trace() to the log file, then clear them.
+	"""
+	global trace_buffer
+	if len(trace_buffer) > 0:
+		logger.error('dump_trace(): last {0} debug messages before error:'.
+						format(len(trace_buffer)))
+		for message, args in trace_buffer:
+			logger.error(message, *args)
+
+		trace_buffer.clear()
+
+
+
 def get_datemode():
 	"""
 	Read datemode from the config object and return it (in integer)
@@ -105,6 +162,20 @@ def get_input_directory():
 
 
 
+def get_key_registry_file():
+	"""
+	Read the key registry file from the config object and return it. If
+	it is not set, return ''.
+	"""
+	global config
+	registry_file = config.get('output', 'key_registry', fallback='').strip()
+	if registry_file != '':
+		registry_file = os.path.join(get_input_directory(), registry_file)
+
+	return registry_file
+
+
+
 def get_record_fields():
 	"""
 	Return the list of data fields used by Geneva 'TransactionRecord'
@@ -123,11 +194,84 @@ def get_record_fields():
 
 
 
+# initialized only once when this module is first imported by others.
+# A trade file usually has only a few distinct dates, so decoded dates
+# and date strings are cached. A cache is cleared when it reaches
+# date_cache_size entries, so it does not grow without limit in a long
+# running process.
+if not 'date_cache' in globals():
+	date_cache = {}			# (decode function, cell value) -> datetime
+	date_string_cache = {}	# datetime -> string
+
+date_cache_size = 10000
+
+
+
 def convert_datetime_to_string(dt):
 	"""
 	convert a datetime object to string in the 'yyyy-mm-dd' format.
 	"""
-	return '{0}-{1}-{2}'.format(dt.year, dt.month, dt.day)
+	global date_string_cache
+	try:
+		return date_string_cache[dt]
+	except KeyError:
+		date_string = '{0}-{1}-{2}'.format(dt.year, dt.month, dt.day)
+		if len(date_string_cache) >= date_cache_size:
+			date_string_cache.clear()
+
+		date_string_cache[dt] = date_string
+		return date_string
+
+
+
+def get_cached_date(cell_value, decode):
+	"""
+	Return decode(cell_value), decode is called only once for the same
+	cell value, after that the date comes from the cache.
+	"""
+	global date_cache
+	key = (decode, cell_value)
+	try:
+		return date_cache[key]
+	except KeyError:
+		dt = decode(cell_value)
+		if len(date_cache) >= date_cache_size:
+			date_cache.clear()
+
+		date_cache[key] = dt
+		return dt
+
+
+
+def clear_date_cache():
+	"""
+	Remove all cached dates and date strings, e.g., after the datemode in
+	the config object is changed.
+	"""
+	global date_cache, date_string_cache
+	date_cache.clear()
+	date_string_cache.clear()
+
+
+
+def excel_date_to_datetime(cell_value):
+	"""
+	Convert an Excel date (serial number) to datetime, using the datemode
+	in the config file. Use it with get_cached_date().
+	"""
+	return xldate_as_datetime(cell_value, get_datemode())
+
+
+
+def mmddyyyy_to_datetime(cell_value):
+	"""
+	Convert a float in the form of 'mmddyyyy' or 'mddyyyy', as in some FT
+	files, to datetime. Use it with get_cached_date().
+	"""
+	month = int(cell_value/1000000)
+	day = int((cell_value - month*1000000)/10000)
+	year = int(cell_value - month*1000000 - day*10000)
+	return datetime(year, month, day)
 
 
 
@@ -145,4 +289,146 @@ def is_empty_cell(ws, row, column):
 	if not isinstance(cell_value, str) or cell_value.strip() != '':
 		return False
 	else:
-		return True
\ No newline at end of file
+		return True
+
+
+def read_row_values(ws, row, ncols):
+	"""
+	Read the first ncols cell values of a row in one call, instead of
+	calling ws.cell_value() once per cell. String values are stripped.
+	"""
+	values = []
+	for cell_value in ws.row_values(row, 0, ncols):
+		if isinstance(cell_value, str):
+			cell_value = cell_value.strip()
+
+		values.append(cell_value)
+
+	return values
+
+
+
+def get_column_converters(fields, converter_map):
+	"""
+	Choose the converter for each column once from the header, so that
+	reading a row does not need to check the field name for every cell.
+
+	fields: the list of data fields (header) of the file.
+
+	converter_map: a dictionary mapping a field name to a function that
+	takes a cell value and returns the converted value. Fields not in the
+	map are kept as is.
+
+	Return the list of converters, one for each column.
+	"""
+	converters = []
+	for fld in fields:
+		converters.append(converter_map.get(fld, keep_value))
+
+	return converters
+
+
+
+def keep_value(cell_value):
+	return cell_value
+
+
+
+def float_to_string(cell_value):
+	"""
+	Some id fields (account number, SEDOL, etc.) are read as float, convert
+	them to string, i.e., 12229.0 -> '12229'.
+	"""
+	if isinstance(cell_value, float):
+		return str(int(cell_value))
+
+	return cell_value
+
+
+
+
+def combine_converters(first, second):
+	"""
+	Return a converter that applies the first converter on a cell value,
+	then the second one on the result.
+	"""
+	def convert(cell_value):
+		return second(first(cell_value))
+
+	return convert
+
+
+
+def get_type_checker(fld, value_type, exception):
+	"""
+	Return a converter that checks whether a cell value of the field is of
+	the value type (str, float or datetime). If yes, the value is returned
+	as is, otherwise it raises the exception.
+	"""
+	type_name = {str:'string', float:'float', datetime:'datetime'}[value_type]
+
+	def check(cell_value):
+		if not isinstance(cell_value, value_type):
+			logger.error('check_field_type(): field {0} should be {1}, value={2}'.
+							format(fld, type_name, cell_value))
+			raise exception()
+
+		return cell_value
+
+	return check
+
+
+
+def get_row_filter(fields, converters, predicates):
+	"""
+	Create a function to decide whether a row should be read, by looking at
+	a few key columns only, so that rows not needed are skipped before the
+	whole row is decoded.
+
+	fields, converters: the data fields of the file and their column
+	converters (see get_column_converters()).
+
+	predicates: a dictionary mapping a field name to a function that takes
+	the converted cell value and returns True if the row should be kept.
+	Fields not in the file are ignored.
+
+	Return a function keep_row(ws, row), which returns True only if all the
+	predicates are satisfied.
+	"""
+	checks = []
+	for fld in predicates:
+		if fld in fields:
+			column = fields.index(fld)
+			checks.append((column, converters[column], predicates[fld]))
+
+	def keep_row(ws, row):
+		for column, convert, predicate in checks:
+			cell_value = ws.cell_value(row, column)
+			if isinstance(cell_value, str):
+				cell_value = cell_value.strip()
+
+			if not predicate(convert(cell_value)):
+				return False
+
+		return True
+
+	return keep_row
+
+
+
+
+def map_files(read_file, files, jobs=1):
+	"""
+	Call read_file(file) for each file, return the list of results in the
+	same order as the files.
+
+	jobs: if more than 1, files are read in parallel by a pool of that many
+	processes. In that case read_file and its results must be picklable,
+	e.g., a module level function returning a list of dictionaries.
+	"""
+	if jobs > 1 and len(files) > 1:
+		logger.debug('map_files(): {0} files, {1} jobs'.format(len(files), jobs))
+		with ProcessPoolExecutor(max_workers=jobs) as executor:
+			return list(executor.map(read_file, files))
+
+	return [read_file(f) for f in files]
@@ -0,0 +1,445 @@
+# coding=utf-8
+#
+# Open the first worksheet of an input file with one of the reader backends
+# below. Whatever the backend is, the worksheet object returned supports the
+# part of the xlrd worksheet interface used by the converters, i.e., nrows,
+# ncols, cell_value() and row_values(), and cell values are the same as
+# what xlrd gives (numbers and dates as float, empty cells as '').
+#
+# 1. xlrd: for .xls files (and .xlsx files with xlrd versions before 2.0).
+# 2. openpyxl: for .xlsx files, read in streaming (read only) mode, only a
+#	small window of rows is kept in memory.
+# 3. csv: for .csv files, all rows are read into memory.
+#
+# To compare the speed of the backends on some sample files, run
+#
+#	python workbook_reader.py <file1> <file2> ...
+#
+# If the cache directory is set in the config file, the cell values read
+# from a file are saved there, keyed by the hash of the file content, so
+# when the same file is read again it is not decoded again.
+#
+
+from trade_converter.utility import logger, config, get_datemode, \
+									get_input_directory
+from xlrd import open_workbook
+from datetime import datetime
+import csv, os, time, hashlib, pickle
+
+try:
+	import openpyxl
+	from openpyxl.utils.datetime import to_excel, WINDOWS_EPOCH, MAC_EPOCH
+except ImportError:
+	openpyxl = None
+
+
+
+class UnknownReaderBackend(Exception):
+	pass
+
+class RowNotAvailable(Exception):
+	pass
+
+
+
+# change it when the cell values read by a backend change, so that files
+# cached by an older version are not used.
+READER_VERSION = 1
+
+
+
+def get_backends(filename):
+	"""
+	Return the list of reader backends available for the file type.
+	"""
+	extension = os.path.splitext(filename)[1].lower()
+	if extension == '.csv':
+		return ['csv']
+
+	backends = ['xlrd']
+	if extension in ['.xlsx', '.xlsm'] and not openpyxl is None:
+		backends.append('openpyxl')
+
+	return backends
+
+
+
+def get_default_backend(filename):
+	"""
+	Choose the backend by file type. For .xlsx files, use the xlsx_reader
+	in the config file, if it is empty, use openpyxl if it is installed.
+	"""
+	extension = os.path.splitext(filename)[1].lower()
+	if extension == '.csv':
+		return 'csv'
+	elif extension in ['.xlsx', '.xlsm']:
+		backend = config.get('excel', 'xlsx_reader', fallback='').strip()
+		if backend != '':
+			return backend
+		elif not openpyxl is None:
+			return 'openpyxl'
+
+	return 'xlrd'
+
+
+
+def open_worksheet(filename, backend=None):
+	"""
+	Open the first worksheet of the file.
+
+	backend: 'xlrd', 'openpyxl' or 'csv', if not given, it is chosen by the
+	file type, see get_default_backend().
+
+	If the parse cache is enabled (see get_cache_directory()), the cell
+	values are read from the cache if the same file has been read before.
+	"""
+	if backend is None:
+		backend = get_default_backend(filename)
+
+	cache_directory = get_cache_directory()
+	if cache_directory != '':
+		return open_cached_worksheet(filename, backend, cache_directory)
+
+	return read_worksheet(filename, backend)
+
+
+
+def read_worksheet(filename, backend):
+	logger.debug('read_worksheet(): {0}, backend={1}'.format(filename, backend))
+	if backend == 'xlrd':
+		wb = open_workbook(filename=filename)
+		return wb.sheet_by_index(0)
+	elif backend == 'openpyxl' and not openpyxl is None:
+		return XlsxWorksheet(filename)
+	elif backend == 'csv':
+		return CsvWorksheet(filename)
+	else:
+		logger.error('read_worksheet(): backend {0} not available'.format(backend))
+		raise UnknownReaderBackend()
+
+
+
+def get_cache_directory():
+	"""
+	Read the parse cache directory from the config object and return it.
+	Return '' if the cache is not used, i.e., the directory is not set or
+	disable_parse_cache() is called.
+	"""
+	if os.environ.get('TRADE_CONVERTER_NO_CACHE', '') == '1':
+		return ''
+
+	directory = config.get('cache', 'directory', fallback='').strip()
+	if directory != '':
+		directory = os.path.join(get_input_directory(), directory)
+
+	return directory
+
+
+
+def disable_parse_cache():
+	"""
+	Do not use the parse cache in this run. As it is done by setting an
+	environment variable, it also works for worker processes started later
+	(see utility.map_files()).
+	"""
+	os.environ['TRADE_CONVERTER_NO_CACHE'] = '1'
+
+
+
+def get_cache_max_size():
+	"""
+	The maximum total size of the cache files, in bytes.
+	"""
+	return int(float(config.get('cache', 'max_size', fallback='500'))*1024*1024)
+
+
+
+def get_file_hash(filename):
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for block in iter(lambda: f.read(1024*1024), b''):
+			sha1.update(block)
+
+	return sha1.hexdigest()
+
+
+
+def open_cached_worksheet(filename, backend, cache_directory):
+	"""
+	Return the worksheet from the cache file of the same content, reader
+	version, backend and datemode (dates are converted with it by some
+	backends). If it does not exist, read the file, save its cell values to
+	the cache, then remove the least recently used cache files if the cache
+	is too big.
+
+	A cache file that cannot be loaded, e.g., it is truncated or saved by
+	an incompatible version, is removed and the file is read again.
+	"""
+	cache_file = os.path.join(cache_directory, '{0}_v{1}_{2}_d{3}.pickle'.
+								format(get_file_hash(filename), READER_VERSION,
+										backend, get_datemode()))
+	try:
+		with open(cache_file, 'rb') as f:
+			rows = pickle.load(f)
+
+		os.utime(cache_file)	# mark it as recently used
+		logger.debug('open_cached_worksheet(): {0} read from cache'.format(filename))
+		return CachedWorksheet(rows)
+
+	except FileNotFoundError:
+		pass
+
+	except Exception as e:
+		logger.warning('open_cached_worksheet(): bad cache file {0} removed: {1}'.
+						format(cache_file, e))
+		try:
+			os.remove(cache_file)
+		except OSError:
+			pass
+
+	ws = read_worksheet(filename, backend)
+	rows = [ws.row_values(rowx) for rowx in range(ws.nrows)]
+
+	if not os.path.exists(cache_directory):
+		os.makedirs(cache_directory)
+
+	# write to a temporary file first, so that other processes never read
+	# a partially written cache file.
+	temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+	with open(temp_file, 'wb') as f:
+		pickle.dump(rows, f, pickle.HIGHEST_PROTOCOL)
+	os.replace(temp_file, cache_file)
+
+	evict_cache_files(cache_directory, get_cache_max_size())
+	return CachedWorksheet(rows)
+
+
+
+def evict_cache_files(cache_directory, max_size):
+	"""
+	Remove the least recently used cache files until the total size is
+	not more than max_size.
+	"""
+	cache_files = []
+	total_size = 0
+	for name in os.listdir(cache_directory):
+		if not name.endswith('.pickle'):
+			continue
+
+		path = os.path.join(cache_directory, name)
+		stat = os.stat(path)
+		cache_files.append((stat.st_mtime, stat.st_size, path))
+		total_size = total_size + stat.st_size
+
+	for mtime, size, path in sorted(cache_files):
+		if total_size <= max_size:
+			break
+
+		logger.debug('evict_cache_files(): remove {0}'.format(path))
+		os.remove(path)
+		total_size = total_size - size
+
+
+
+class CachedWorksheet(object):
+	"""
+	A worksheet whose cell values are all in memory, as a list of rows.
+	"""
+	def __init__(self, rows):
+		self.rows = rows
+		self.nrows = len(rows)
+		if self.nrows > 0:
+			self.ncols = len(rows[0])
+		else:
+			self.ncols = 0
+
+	def cell_value(self, rowx, colx):
+		return self.rows[rowx][colx]
+
+	def row_values(self, rowx, start_colx=0, end_colx=None):
+		return self.rows[rowx][start_colx:end_colx]
+
+	def close(self):
+		pass
+
+
+
+class RowStreamWorksheet(object):
+	"""
+	A worksheet whose rows come from an iterator. Rows are read when they
+	are first accessed, and only the last window_size rows are kept, so
+	rows must be accessed roughly in order, as the converters do. close()
+	is called when the last row is read.
+	"""
+	window_size = 100
+
+	def __init__(self, rows, nrows, ncols):
+		self.rows = rows
+		self.nrows = nrows
+		self.ncols = ncols
+		self.buffer = {}
+		self.next_row = 0
+
+	def get_row(self, rowx):
+		while self.next_row <= rowx:
+			if self.next_row < self.nrows:
+				values = self.normalize_row(next(self.rows, ()))
+			else:
+				values = self.normalize_row(())
+			self.buffer[self.next_row] = values
+			self.buffer.pop(self.next_row - self.window_size, None)
+			self.next_row = self.next_row + 1
+			if self.next_row == self.nrows:
+				self.close()
+
+		try:
+			return self.buffer[rowx]
+		except KeyError:
+			logger.error('get_row(): row {0} is no longer available'.format(rowx))
+			raise RowNotAvailable()
+
+	def close(self):
+		pass
+
+	def normalize_row(self, values):
+		row = []
+		for value in values[:self.ncols]:
+			row.append(self.normalize_value(value))
+
+		while len(row) < self.ncols:
+			row.append('')
+
+		return row
+
+	def normalize_value(self, value):
+		return value
+
+	def cell_value(self, rowx, colx):
+		return self.get_row(rowx)[colx]
+
+	def row_values(self, rowx, start_colx=0, end_colx=None):
+		return self.get_row(rowx)[start_colx:end_colx]
+
+
+
+class XlsxWorksheet(RowStreamWorksheet):
+	"""
+	Read the first worksheet of a .xlsx file with openpyxl in read only
+	mode. Dates are converted back to Excel serial numbers and integers
+	to float, the same as xlrd.
+
+	The workbook is closed when the last row is read, or by close().
+	"""
+	def __init__(self, filename):
+		self.workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+		ws = self.workbook.worksheets[0]
+
+		# the dimension in the file may be missing or wrong, so the rows
+		# are counted instead, it costs one more pass over the rows.
+		ws.reset_dimensions()
+		nrows = 0
+		ncols = 0
+		for values in ws.iter_rows(values_only=True):
+			nrows = nrows + 1
+			ncols = max(ncols, len(values))
+
+		if get_datemode() == 1:
+			self.epoch = MAC_EPOCH
+		else:
+			self.epoch = WINDOWS_EPOCH
+
+		super(XlsxWorksheet, self).__init__(ws.iter_rows(values_only=True),
+											nrows, ncols)
+		if nrows == 0:
+			self.close()
+
+	def close(self):
+		self.workbook.close()
+
+	def normalize_value(self, value):
+		if value is None:
+			return ''
+		elif isinstance(value, bool):
+			return int(value)
+		elif isinstance(value, int):
+			return float(value)
+		elif isinstance(value, datetime):
+			return float(to_excel(value, self.epoch))
+		else:
+			return value
+
+
+
+class CsvWorksheet(CachedWorksheet):
+	"""
+	Read a .csv file as a worksheet, all rows are read at once. Values that
+	look like numbers are converted to float, the same as xlrd. Dates must
+	be numbers too, i.e., Excel serial numbers or FT's 'mmddyyyy' format.
+	"""
+	def __init__(self, filename):
+		with open(filename, newline='') as f:
+			rows = [[self.normalize_value(value) for value in values] \
+						for values in csv.reader(f)]
+
+		ncols = max([len(row) for row in rows] + [0])
+		for row in rows:
+			row.extend([''] * (ncols - len(row)))
+
+		super(CsvWorksheet, self).__init__(rows)
+
+	def normalize_value(self, value):
+		try:
+			return float(value)
+		except ValueError:
+			return value
+
+
+
+def close_worksheet(ws):
+	"""
+	Release the file held by a worksheet from open_worksheet(), if any. Call
+	it when a converter stops before the last row, e.g., at a blank line.
+	"""
+	if hasattr(ws, 'close'):
+		ws.close()
+
+
+
+def benchmark_backends(files):
+	"""
+	Read all cells of each file with every backend available, return the
+	fastest backend for each file type, as a dictionary like
+
+	{'.xls': 'xlrd', '.xlsx': 'openpyxl'}
+
+	A backend that fails to read a file is skipped.
+	"""
+	timing = {}
+	for filename in files:
+		extension = os.path.splitext(filename)[1].lower()
+		for backend in get_backends(filename):
+			start = time.perf_counter()
+			try:
+				ws = read_worksheet(filename, backend)
+				for rowx in range(ws.nrows):
+					ws.row_values(rowx)
+			except Exception:
+				continue
+
+			elapsed = time.perf_counter() - start
+			print('{0}: {1}, {2:.3f} seconds'.format(filename, backend, elapsed))
+			key = (extension, backend)
+			timing[key] = timing.get(key, 0) + elapsed
+
+	fastest = {}
+	for (extension, backend), elapsed in sorted(timing.items()):
+		if not extension in fastest or elapsed < timing[(extension, fastest[extension])]:
+			fastest[extension] = backend
+
+	return fastest
+
+
+
+if __name__ == '__main__':
+	import sys
+	print(benchmark_backends(sys.argv[1:]))